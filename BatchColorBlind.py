@@ -0,0 +1,405 @@
+#!/usr/bin/python
+
+# std python imports
+import os
+import os.path
+import sys
+import time
+import json
+import uuid
+import errno
+import socket
+import hashlib
+import threading
+import traceback
+import multiprocessing
+
+# other imports
+import numpy
+
+import skimage
+import skimage.io
+
+import click
+
+##
+from ExecutionPlanner import planExecution
+from ExecutionPlanner import executePlan
+from ExecutionPlanner import pixelFunction
+
+
+# File based job queue on shared storage.
+# Each job is a json file that moves between the state directories of the queue:
+#
+#	pending/<id>.json				waiting to be claimed
+#	running/<id>.<worker_id>.json	claimed by a worker. the worker touches it every heartbeat
+#	running/<id>.<uuid>.moving		being updated on its way to another state
+#	done/<id>.json					finished
+#	failed/<id>.json				gave up after max attempts
+#
+# Every state change is an os.rename(), which is atomic on a single (shared) filesystem,
+# so only one worker can win a claim. Jobs whose running file has not been touched for
+# longer than the timeout belong to a dead worker and are moved back to pending.
+QUEUE_STATES = ['pending', 'running', 'done', 'failed', 'tmp']
+
+@click.group()
+def batch():
+	pass
+
+
+@batch.command()
+@click.option('-m', '--mode', 'mode', default='simulate', type=click.Choice(['simulate', 'correct', 'contrast']), help='Transform to apply to each image.')
+@click.option('-t', '--type', 'color_blind_types', multiple=True, type=click.Choice(['protanopia', 'deuteranopia', 'tritanopia']), help='Color blindness type. Can be given more than once.')
+@click.option('--sensitivity', 'sensitivities', multiple=True, type=click.FLOAT, help='Color blindness sensitivity. Can be given more than once.')
+@click.option('-o', '--out-dir', 'output_dir', required=True, type=click.Path(exists=False, file_okay=False, dir_okay=True, resolve_path=True), help='Directory for the resulting images. Must be on storage shared by all workers.')
+@click.argument('queue_dir', type=click.Path(exists=False, file_okay=False, dir_okay=True, resolve_path=False))
+@click.argument('input_file_names', nargs=-1, type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=True))
+def submit(mode, color_blind_types, sensitivities, output_dir, queue_dir, input_file_names):
+	# Coordinator. Adds one job per (image, type, sensitivity) to the queue.
+	if (len(sensitivities) == 0):
+		sensitivities = (0,)
+
+	###
+	# print options/arguments
+	print 'Mode = ' + str(mode)
+	print 'Color blind types = ' + str(color_blind_types)
+	print 'Sensitivities = ' + str(sensitivities)
+	print 'Queue = "' + str(queue_dir) + '"'
+	print 'Output directory = "' + str(output_dir) + '"'
+	print 'Input images = ' + str(len(input_file_names))
+	print ''
+
+	if (len(color_blind_types) == 0):
+		print 'No color blind type given'
+		exit(1)
+
+	if (mode != 'simulate' and 0 in [numpy.clip(sensitivity, 0, 1) for sensitivity in sensitivities]):
+		print 'Sensitivity == 0, cannot correct color blindness'
+		exit(1)
+
+	makeQueue(queue_dir)
+	if (not os.path.isdir(output_dir)):
+		os.makedirs(output_dir)
+
+	num_added = 0
+	num_skipped = 0
+	for input_file_name in input_file_names:
+		for color_blind_type in color_blind_types:
+			for sensitivity in sensitivities:
+				job = newJob(mode, input_file_name, color_blind_type, float(numpy.clip(sensitivity, 0, 1)), output_dir)
+				if (addJob(queue_dir, job)):
+					num_added += 1
+				else:
+					num_skipped += 1
+
+	print 'Jobs added = ' + str(num_added)
+	print 'Jobs already in queue = ' + str(num_skipped)
+	print ''
+
+
+@batch.command()
+@click.option('--heartbeat', 'heartbeat_interval', default=10.0, type=click.FLOAT, help='Seconds between heartbeats of a running job.')
+@click.option('--timeout', 'timeout', default=60.0, type=click.FLOAT, help='Seconds without a heartbeat before a running job is handed to another worker.')
+@click.option('--max-attempts', 'max_attempts', default=3, type=click.INT, help='Number of attempts before a job is marked as failed.')
+@click.option('--poll', 'poll_interval', default=2.0, type=click.FLOAT, help='Seconds to wait before checking the queue again when nothing can be claimed.')
+@click.option('-p', '--processes', 'num_processes', default=1, type=click.INT, help='Number of local worker processes to start.')
+@click.argument('queue_dir', type=click.Path(exists=True, file_okay=False, dir_okay=True, resolve_path=False))
+def work(heartbeat_interval, timeout, max_attempts, poll_interval, num_processes, queue_dir):
+	# Worker. Claims and runs jobs until the queue is empty.
+	worker_id = socket.gethostname().split('.')[0] + '-' + str(os.getpid())
+
+	###
+	# print options/arguments
+	print 'Queue = "' + str(queue_dir) + '"'
+	print 'Worker = ' + str(worker_id)
+	print 'Processes = ' + str(num_processes)
+	print 'Heartbeat = ' + str(heartbeat_interval)
+	print 'Timeout = ' + str(timeout)
+	print 'Max attempts = ' + str(max_attempts)
+	print ''
+
+	if (timeout <= heartbeat_interval):
+		print 'Timeout must be longer than the heartbeat interval'
+		exit(1)
+
+	if (num_processes <= 1):
+		workerLoop(queue_dir, worker_id, heartbeat_interval, timeout, max_attempts, poll_interval)
+		return
+
+	processes = []
+	for k in range(num_processes):
+		process = multiprocessing.Process(target=workerLoop,
+			args=(queue_dir, worker_id + '-' + str(k), heartbeat_interval, timeout, max_attempts, poll_interval))
+		process.start()
+		processes.append(process)
+
+	for process in processes:
+		process.join()
+
+
+@batch.command()
+@click.argument('queue_dir', type=click.Path(exists=True, file_okay=False, dir_okay=True, resolve_path=False))
+def status(queue_dir):
+	for state in ['pending', 'running', 'done', 'failed']:
+		print state + ' = ' + str(len(listJobs(queue_dir, state)))
+	print ''
+
+	for job_file_name in listJobs(queue_dir, 'failed'):
+		job = readJob(os.path.join(queue_dir, 'failed', job_file_name))
+		print 'Failed "' + str(job['input']) + '" ' + str(job['type']) + ' ' + str(job['sensitivity'])
+		if (len(job['errors']) > 0):
+			print job['errors'][-1]
+
+
+# Creates the state directories of the queue.
+def makeQueue(queue_dir):
+	for state in QUEUE_STATES:
+		path = os.path.join(queue_dir, state)
+		if (not os.path.isdir(path)):
+			try:
+				os.makedirs(path)
+			except OSError as e:
+				if (e.errno != errno.EEXIST):
+					raise
+
+def listJobs(queue_dir, state):
+	return sorted([name for name in os.listdir(os.path.join(queue_dir, state)) if name.endswith('.json')])
+
+# returns a new job dictionary. The job id only depends on what the job computes,
+# so submitting the same manifest twice does not duplicate work.
+def newJob(mode, input_file_name, color_blind_type, sensitivity, output_dir):
+	(name, extension) = os.path.splitext(os.path.basename(input_file_name))
+	key = json.dumps([mode, input_file_name, color_blind_type, sensitivity])
+
+	return {
+		'id': hashlib.sha1(key).hexdigest()[0:16],
+		'mode': mode,
+		'input': input_file_name,
+		'output': os.path.join(output_dir, mode + '_' + color_blind_type + '_' + str(sensitivity) + '_' + name + '.png'),
+		'type': color_blind_type,
+		'sensitivity': sensitivity,
+		'attempts': 0,
+		'errors': [],
+	}
+
+def readJob(path):
+	with open(path, 'r') as job_file:
+		return json.load(job_file)
+
+# Writes <job> to <path> atomically, through a temporary file in the queue.
+def writeJob(queue_dir, path, job):
+	tmp_path = os.path.join(queue_dir, 'tmp', uuid.uuid4().hex)
+	with open(tmp_path, 'w') as job_file:
+		json.dump(job, job_file)
+	os.rename(tmp_path, path)
+
+# returns False if the job is already in the queue.
+def addJob(queue_dir, job):
+	for state in ['pending', 'done', 'failed']:
+		if (os.path.exists(os.path.join(queue_dir, state, job['id'] + '.json'))):
+			return False
+	for job_file_name in os.listdir(os.path.join(queue_dir, 'running')):
+		if (job_file_name.split('.')[0] == job['id']):
+			return False
+
+	writeJob(queue_dir, os.path.join(queue_dir, 'pending', job['id'] + '.json'), job)
+	return True
+
+# Atomically moves <src_path> to <dest_state> and stores <job> in it.
+# The job is first renamed to a private staging file in running/, which decides the winner.
+# Only then are the new contents writen straight into <dest_state>, so the job can never be
+# claimed with its old contents, or be in two states at once.
+# A worker dying half way leaves the staging file, which requeueStaleJobs recovers.
+# returns False if somebody else moved <src_path> first.
+def moveJob(queue_dir, src_path, job, dest_state):
+	staging_path = os.path.join(queue_dir, 'running', job['id'] + '.' + uuid.uuid4().hex + '.moving')
+	try:
+		# rename() keeps the modification time, so touch first.
+		# otherwise the staging file could look stale right away.
+		os.utime(src_path, None)
+		os.rename(src_path, staging_path)
+	except OSError:
+		return False
+
+	writeJob(queue_dir, os.path.join(queue_dir, dest_state, job['id'] + '.json'), job)
+	os.remove(staging_path)
+	return True
+
+# Claims the next pending job for <worker_id>.
+# returns the path of the claimed (running) job file, or None if nothing could be claimed.
+def claimJob(queue_dir, worker_id):
+	for job_file_name in listJobs(queue_dir, 'pending'):
+		pending_path = os.path.join(queue_dir, 'pending', job_file_name)
+		running_path = os.path.join(queue_dir, 'running', job_file_name[0:-len('.json')] + '.' + worker_id + '.json')
+		try:
+			# rename() keeps the modification time, so touch first.
+			# otherwise the claimed job could look stale right away.
+			os.utime(pending_path, None)
+			os.rename(pending_path, running_path)
+		except OSError:
+			continue
+
+		return running_path
+
+	return None
+
+# returns the current time on the clock that stamps the queue files.
+# On shared storage the modification times come from the file server, so comparing
+# them with the local clock breaks when the clocks of the nodes are skewed. Instead
+# touch a probe file in the queue and read its modification time back.
+def queueTime(queue_dir, worker_id):
+	probe_path = os.path.join(queue_dir, 'tmp', 'clock.' + worker_id)
+	with open(probe_path, 'a'):
+		pass
+	os.utime(probe_path, None)
+	return os.path.getmtime(probe_path)
+
+# Moves jobs of dead workers back to pending, or to failed after <max_attempts>.
+# returns the number of jobs that are still running.
+def requeueStaleJobs(queue_dir, worker_id, timeout, max_attempts):
+	now = queueTime(queue_dir, worker_id)
+	num_running = 0
+	for job_file_name in listJobs(queue_dir, 'running'):
+		running_path = os.path.join(queue_dir, 'running', job_file_name)
+		try:
+			age = now - os.path.getmtime(running_path)
+			job = readJob(running_path)
+		except (OSError, IOError, ValueError):
+			# finished, requeued or still being written by someone else
+			continue
+
+		if (age <= timeout):
+			num_running += 1
+			continue
+
+		job['attempts'] += 1
+		job['errors'].append('No heartbeat from ' + job_file_name.split('.')[1] + ' for ' + str(int(age)) + ' seconds')
+		dest_state = 'failed' if (job['attempts'] >= max_attempts) else 'pending'
+		if (moveJob(queue_dir, running_path, job, dest_state)):
+			print 'Requeued stale job ' + str(job['id']) + ' -> ' + dest_state
+
+	# staging files of workers that died while moving a job.
+	# the job is put back in pending, unless it already made it to its new state.
+	for staging_file_name in os.listdir(os.path.join(queue_dir, 'running')):
+		if (not staging_file_name.endswith('.moving')):
+			continue
+		staging_path = os.path.join(queue_dir, 'running', staging_file_name)
+		job_id = staging_file_name.split('.')[0]
+		try:
+			age = now - os.path.getmtime(staging_path)
+			if (age <= timeout):
+				num_running += 1
+				continue
+			if (any([os.path.exists(os.path.join(queue_dir, state, job_id + '.json')) for state in ['pending', 'done', 'failed']])):
+				os.remove(staging_path)
+			else:
+				os.rename(staging_path, os.path.join(queue_dir, 'pending', job_id + '.json'))
+				print 'Recovered job ' + str(job_id) + ' -> pending'
+		except OSError:
+			# recovered by someone else
+			pass
+
+	# temporary job files of writers that died before renaming them into place.
+	# a complete one is put back in pending, unless the job is already in the queue.
+	# (old clock probes of other workers are removed too)
+	for tmp_file_name in sorted(os.listdir(os.path.join(queue_dir, 'tmp'))):
+		tmp_path = os.path.join(queue_dir, 'tmp', tmp_file_name)
+		try:
+			age = now - os.path.getmtime(tmp_path)
+			if (age <= timeout):
+				continue
+			job = readJob(tmp_path)
+			if (addJob(queue_dir, job)):
+				print 'Recovered job ' + str(job['id']) + ' -> pending'
+		except (OSError, IOError, ValueError, KeyError, TypeError):
+			pass
+
+		try:
+			os.remove(tmp_path)
+		except OSError:
+			pass
+
+	return num_running
+
+# Touches <path> every <interval> seconds until <stop> is set.
+# Sets <lost> if the job file disappeared, ie. the job was handed to another worker.
+def heartbeat(path, interval, stop, lost):
+	while (not stop.wait(interval)):
+		try:
+			os.utime(path, None)
+		except OSError:
+			lost.set()
+			return
+
+# Runs one job. The result is written through a temporary file so that a half written
+# image is never visible, even if the same job ends up running on two workers.
+def processJob(job):
+	image = skimage.io.imread(job['input'], as_grey=False)
+	image = skimage.img_as_ubyte(image, force_copy=False)
+	image = image[:,:,0:3]
+
+	plan = planExecution(image, None, job['input'])
+	mod_image = executePlan(plan, image, None, pixelFunction(job['mode']), job['type'], job['sensitivity'])
+
+	(head, tail) = os.path.split(job['output'])
+	tmp_output_file_name = os.path.join(head, '.' + uuid.uuid4().hex + '_' + tail)
+	skimage.io.imsave(tmp_output_file_name, mod_image)
+	os.rename(tmp_output_file_name, job['output'])
+
+def workerLoop(queue_dir, worker_id, heartbeat_interval, timeout, max_attempts, poll_interval):
+	num_done = 0
+	while True:
+		num_running = requeueStaleJobs(queue_dir, worker_id, timeout, max_attempts)
+
+		running_path = claimJob(queue_dir, worker_id)
+		if (running_path is None):
+			if (num_running == 0 and len(listJobs(queue_dir, 'pending')) == 0):
+				break
+			time.sleep(poll_interval)
+			continue
+
+		job = readJob(running_path)
+		print '[' + worker_id + '] Running ' + str(job['id']) + ' "' + str(job['input']) + '" ' + str(job['type']) + ' ' + str(job['sensitivity'])
+		sys.stdout.flush()
+
+		stop = threading.Event()
+		lost = threading.Event()
+		heartbeat_thread = threading.Thread(target=heartbeat, args=(running_path, heartbeat_interval, stop, lost))
+		heartbeat_thread.daemon = True
+		heartbeat_thread.start()
+
+		error = None
+		try:
+			processJob(job)
+		except Exception:
+			error = traceback.format_exc()
+
+		stop.set()
+		heartbeat_thread.join()
+
+		if (error is None):
+			dest_state = 'done'
+		else:
+			job['attempts'] += 1
+			job['errors'].append('[' + worker_id + '] ' + error)
+			dest_state = 'failed' if (job['attempts'] >= max_attempts) else 'pending'
+
+		if (lost.is_set() or not moveJob(queue_dir, running_path, job, dest_state)):
+			print '[' + worker_id + '] Lost job ' + str(job['id']) + ' to another worker'
+		else:
+			print '[' + worker_id + '] ' + str(job['id']) + ' -> ' + dest_state
+			if (dest_state == 'done'):
+				num_done += 1
+		sys.stdout.flush()
+
+	try:
+		os.remove(os.path.join(queue_dir, 'tmp', 'clock.' + worker_id))
+	except OSError:
+		pass
+
+	print '[' + worker_id + '] Queue empty. Jobs done = ' + str(num_done)
+
+
+# MAIN
+if __name__ == '__main__':
+	batch()
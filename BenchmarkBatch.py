@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+# std python imports
+import time
+
+# other imports
+import numpy
+
+import skimage
+import skimage.io
+
+import click
+
+##
+from SimulateColorBlind import transformImages
+from ExecutionPlanner import pixelFunction
+
+
+@click.command()
+@click.option('-m', '--mode', 'mode', default='simulate', type=click.Choice(['simulate', 'correct', 'contrast']), help='Transform to benchmark.')
+@click.option('-t', '--type', 'color_blind_type', default='protanopia', type=click.Choice(['protanopia', 'deuteranopia', 'tritanopia']), help='Color blindness type')
+@click.option('--sensitivity', 'sensitivity', default=.3, type=click.FLOAT, help='Color blindness sensitivity.\n0: no response\n 1: full response')
+@click.option('-n', '--count', 'num_images', default=1000, type=click.INT, help='Number of small images.')
+@click.option('--min-size', 'min_size', default=8, type=click.INT, help='Smallest image side in pixels.')
+@click.option('--max-size', 'max_size', default=32, type=click.INT, help='Largest image side in pixels.')
+@click.option('--repeat', 'repeat', default=3, type=click.INT, help='Number of timed runs. The best run is reported.')
+@click.argument('input_file_name', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=False) )
+def benchmark(mode, color_blind_type, sensitivity, num_images, min_size, max_size, repeat, input_file_name):
+	# Compares transforming many small images one call per image against one stacked call.
+	# The small images are random crops of mixed sizes from <input_file_name>, every other one with alpha.
+
+	###
+	# print options/arguments
+	print 'Mode = ' + str(mode)
+	print 'Color blind type = ' + str(color_blind_type)
+	print 'Sensitivity = ' + str(sensitivity)
+	print 'Images = ' + str(num_images) + ', ' + str(min_size) + ' to ' + str(max_size) + ' pixels per side'
+	print ''
+	print 'Input image = "' + str(input_file_name) + '"'
+	print ''
+
+
+	###
+	# build small images
+	image = skimage.img_as_ubyte(skimage.io.imread(input_file_name, as_grey=False), force_copy=False)[:,:,0:3]
+	random = numpy.random.RandomState(0)
+	images = []
+	for k in range(num_images):
+		(height, width) = random.randint(min_size, max_size + 1, size=2)
+		y = random.randint(0, image.shape[0] - height + 1)
+		x = random.randint(0, image.shape[1] - width + 1)
+		small_image = image[y:y+height, x:x+width]
+		if (k % 2 == 1):
+			small_image = numpy.dstack((small_image, numpy.full((height, width), 255, dtype=numpy.uint8)))
+		images.append(small_image)
+
+
+	###
+	# time both ways
+	pixel_function = pixelFunction(mode)
+
+	def perImage():
+		return [transformImages([small_image], pixel_function, color_blind_type, sensitivity)[0] for small_image in images]
+
+	def stacked():
+		return transformImages(images, pixel_function, color_blind_type, sensitivity)
+
+	per_image_time = bestTime(perImage, repeat)
+	stacked_time = bestTime(stacked, repeat)
+
+	# both ways must give the same images
+	for (a, b) in zip(perImage(), stacked()):
+		assert (a.shape == b.shape and (a == b).all())
+
+	print 'One call per image = ' + ('%.1f' % (num_images / per_image_time)) + ' images/s'
+	print 'Stacked = ' + ('%.1f' % (num_images / stacked_time)) + ' images/s'
+	print 'Speedup = ' + ('%.1f' % (per_image_time / stacked_time)) + 'x'
+	print ''
+
+
+def bestTime(function, repeat):
+	best = None
+	for k in range(repeat):
+		start_time = time.time()
+		function()
+		elapsed_time = time.time() - start_time
+		best = elapsed_time if (best is None) else min(best, elapsed_time)
+	return best
+
+
+# MAIN
+if __name__ == '__main__':
+	benchmark()
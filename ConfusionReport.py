@@ -0,0 +1,231 @@
+#!/usr/bin/python
+
+# other imports
+import numpy
+
+import skimage
+import skimage.io
+
+import click
+
+##
+from SimulateColorBlind import RGBToxyY
+from SimulateColorBlind import onBlindSide
+from SimulateColorBlind import displacementAngle
+from SimulateColorBlind import R_COPUNCTAL
+from SimulateColorBlind import G_COPUNCTAL
+from SimulateColorBlind import B_COPUNCTAL
+from ExecutionPlanner import packRGB
+from ExecutionPlanner import unpackRGB
+
+
+@click.command()
+@click.option('-t', '--type', 'color_blind_types', multiple=True, type=click.Choice(['protanopia', 'deuteranopia', 'tritanopia']), help='Color blindness type. Can be given more than once. Default is all types.')
+@click.option('--bins', 'bins', default=256, type=click.INT, help='Number of xy histogram bins along each axis.')
+@click.option('--angle-width', 'angle_width', default=0.5, type=click.FLOAT, help='Width in degrees of the confusion line groups around the copunctal point.')
+@click.option('--min-distance', 'min_distance', default=.04, type=click.FLOAT, help='Minimum xy distance between two colors on the same confusion line for them to count as confusable.')
+@click.option('--lightness-bins', 'lightness_bins', default=10, type=click.INT, help='Number of lightness (CIE L*) bins. Colors of different lightness are kept in separate bins.')
+@click.option('--max-lightness-diff', 'max_lightness_diff', default=10, type=click.FLOAT, help='Maximum CIE L* difference (0 to 100) between two colors for them to count as confusable. Lighter/darker colors can be told apart by lightness.')
+@click.option('--min-lightness', 'min_lightness', default=12, type=click.FLOAT, help='Ignore colors darker than this CIE L* (0 to 100). Their chromaticity is noise and their hue cannot be seen.')
+@click.option('--min-fraction', 'min_fraction', default=.001, type=click.FLOAT, help='Ignore xy bins holding less than this fraction of the pixels.')
+@click.option('-n', '--pairs', 'num_pairs', default=5, type=click.INT, help='Number of worst confusable color pairs to report.')
+@click.option('--csv', 'csv_file_name', type=click.Path(exists=False, file_okay=True, dir_okay=False, resolve_path=False, writable=True), help='Also write a one line per image/type summary to this csv file.')
+@click.argument('input_file_names', nargs=-1, type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=False))
+def confusion_report(color_blind_types, bins, angle_width, min_distance, lightness_bins, max_lightness_diff, min_lightness, min_fraction, num_pairs, csv_file_name, input_file_names):
+	# Reports which colors of an image fall on the same dichromat confusion line.
+	# Colors on the same line only count as confusable if their lightness is similar too.
+	if (len(color_blind_types) == 0):
+		color_blind_types = ('protanopia', 'deuteranopia', 'tritanopia')
+
+	###
+	# print options/arguments
+	print 'Color blind types = ' + str(color_blind_types)
+	print 'xy bins = ' + str(bins) + 'x' + str(bins)
+	print 'Angle width = ' + str(angle_width)
+	print 'Min distance = ' + str(min_distance)
+	print 'Lightness bins = ' + str(lightness_bins)
+	print 'Max lightness difference = ' + str(max_lightness_diff)
+	print 'Min lightness = ' + str(min_lightness)
+	print 'Min fraction = ' + str(min_fraction)
+	print 'CSV file = ' + str(csv_file_name)
+	print ''
+
+	csv_file = None
+	if (csv_file_name is not None):
+		csv_file = open(csv_file_name, 'w')
+		csv_file.write('image,type,at_risk,blind_side,worst_pair_distance\n')
+
+	for input_file_name in input_file_names:
+		###
+		# read image
+		image = skimage.io.imread(input_file_name, as_grey=False)
+
+		# convert to 8-bit
+		image = skimage.img_as_ubyte(image, force_copy=False)
+
+		# remove alpha channel if present
+		image = image[:,:,0:3]
+
+
+		###
+		# bin into xy/lightness histogram
+		(bin_counts, bin_cell, bin_xy, bin_L, bin_rgb) = chromaticityHistogram(image, bins, lightness_bins)
+
+		print 'Image = "' + str(input_file_name) + '"'
+		print 'Pixels = ' + str(numpy.sum(bin_counts)) + ', occupied bins = ' + str(bin_counts.shape[0])
+
+
+		###
+		# report per type
+		for color_blind_type in color_blind_types:
+			report = confusionReport(bin_counts, bin_cell, bin_xy, bin_L, bin_rgb, color_blind_type, numpy.radians(angle_width), min_distance, max_lightness_diff, min_lightness, min_fraction, num_pairs)
+
+			print '  ' + color_blind_type + ':'
+			print '    Pixels at risk = ' + ('%.1f' % (100*report['at_risk'])) + '%'
+			print '    Pixels on blind side = ' + ('%.1f' % (100*report['blind_side'])) + '%'
+			if (len(report['pairs']) > 0):
+				print '    Worst confusable pairs:'
+			for pair in report['pairs']:
+				print '      ' + hexColor(pair['rgb'][0]) + ' (' + ('%.1f' % (100*pair['fraction'][0])) + '%)' + \
+					' <-> ' + hexColor(pair['rgb'][1]) + ' (' + ('%.1f' % (100*pair['fraction'][1])) + '%)' + \
+					', xy distance = ' + ('%.3f' % pair['distance'])
+
+			if (csv_file is not None):
+				worst_distance = report['pairs'][0]['distance'] if (len(report['pairs']) > 0) else 0
+				csv_file.write('"' + str(input_file_name) + '",' + color_blind_type + ',' + ('%.4f' % report['at_risk']) + ',' + \
+					('%.4f' % report['blind_side']) + ',' + ('%.4f' % worst_distance) + '\n')
+
+		print ''
+
+	if (csv_file is not None):
+		csv_file.close()
+		print 'Summary writen to = "' + str(csv_file_name) + '"'
+
+
+# Bins all pixels of <image> into a <bins>x<bins>x<lightness_bins> histogram over
+# xy chromatic space and CIE L* lightness.
+# Pixels are reduced to their unique colors first, so only distinct colors are converted.
+# image := numpy array of shape (M,N,3). dtype=uint8
+# returns (bin_counts, bin_cell, bin_xy, bin_L, bin_rgb) for the occupied bins only.
+#	bin_counts := numpy array of shape (B,). number of pixels in each bin
+#	bin_cell := numpy array of shape (B,). index of the xy cell of each bin. (shared by all lightness bins)
+#	bin_xy := numpy array of shape (B,2). mean xy of the pixels in each bin
+#	bin_L := numpy array of shape (B,). mean L* of the pixels in each bin. from 0 to 100
+#	bin_rgb := numpy array of shape (B,3). mean RGB of the pixels in each bin
+def chromaticityHistogram(image, bins, lightness_bins):
+	(colors, color_counts) = numpy.unique(packRGB(image.reshape(-1, 3)), return_counts=True)
+	colors = unpackRGB(colors)
+	(colors_xy, colors_Y) = RGBToxyY(colors)
+	colors_L = lightness(colors_Y)
+
+	# flat bin index of each color. (xy values are always within [0,1])
+	bin_x = numpy.clip((colors_xy[:,0] * bins).astype(int), 0, bins-1)
+	bin_y = numpy.clip((colors_xy[:,1] * bins).astype(int), 0, bins-1)
+	bin_l = numpy.clip((colors_L / 100.0 * lightness_bins).astype(int), 0, lightness_bins-1)
+	bin_index = (bin_x*bins + bin_y)*lightness_bins + bin_l
+	num_bins = bins*bins*lightness_bins
+
+	counts = numpy.bincount(bin_index, weights=color_counts, minlength=num_bins)
+	occupied = numpy.nonzero(counts)[0]
+	bin_counts = counts[occupied]
+
+	bin_xy = numpy.zeros((occupied.shape[0], 2), dtype=float)
+	for k in range(2):
+		bin_xy[:,k] = numpy.bincount(bin_index, weights=color_counts*colors_xy[:,k], minlength=num_bins)[occupied] / bin_counts
+
+	bin_L = numpy.bincount(bin_index, weights=color_counts*colors_L, minlength=num_bins)[occupied] / bin_counts
+
+	bin_rgb = numpy.zeros((occupied.shape[0], 3), dtype=float)
+	for k in range(3):
+		bin_rgb[:,k] = numpy.bincount(bin_index, weights=color_counts*colors[:,k], minlength=num_bins)[occupied] / bin_counts
+
+	return (bin_counts.astype(int), occupied // lightness_bins, bin_xy, bin_L, bin_rgb)
+
+# CIE L* lightness of relative luminance Y (white = 1).
+# returns numpy array of shape (N,). from 0 to 100
+def lightness(Y):
+	Y = numpy.clip(Y, 0, 1)
+	return numpy.where(Y > 216/24389.0, 116*numpy.cbrt(Y) - 16, Y * 24389/27.0)
+
+
+# Groups bins by the angle of their confusion line around the copunctal point.
+# Bins in the same group that are more than <min_distance> apart, but within
+# <max_lightness_diff> in L*, are seen as the same color by a dichromat of <color_blind_type>.
+# Bins darker than <min_lightness> are left out, their xy is not meaningful.
+# angle_width := width of the angle groups in radians.
+# returns a dictionary with
+#	'at_risk' := fraction of pixels that have a confusable partner color
+#	'blind_side' := fraction of pixels on the blind side (see onBlindSide)
+#	'pairs' := up to <num_pairs> worst confusable pairs. one per confusion line
+def confusionReport(bin_counts, bin_cell, bin_xy, bin_L, bin_rgb, color_blind_type, angle_width, min_distance, max_lightness_diff, min_lightness, min_fraction, num_pairs):
+	if (color_blind_type == 'protanopia'):
+		copunctal = numpy.array(R_COPUNCTAL, dtype=float)
+
+	elif (color_blind_type == 'deuteranopia'):
+		copunctal = numpy.array(G_COPUNCTAL, dtype=float)
+
+	elif (color_blind_type == 'tritanopia'):
+		copunctal = numpy.array(B_COPUNCTAL, dtype=float)
+
+	else:
+		print 'Invalid color_blind_type: ' + str(color_blind_type)
+		exit(1)
+
+	total = float(numpy.sum(bin_counts))
+	fractions = bin_counts / total
+
+	# confusion line angle and position along the line of each bin
+	disp_from_copunctal = bin_xy - copunctal
+	angle = displacementAngle(disp_from_copunctal)
+	radius = numpy.linalg.norm(disp_from_copunctal, axis=1)
+	group = numpy.floor(angle / angle_width).astype(int)
+
+	blind_side = numpy.sum(fractions[onBlindSide(bin_xy, color_blind_type)])
+
+	# walk the significant bins group by group, ordered by radius within each group.
+	# significance is decided per xy cell, so splitting a color by lightness does not hide it.
+	cell_fractions = numpy.bincount(bin_cell, weights=fractions)[bin_cell]
+	significant = numpy.nonzero((cell_fractions >= min_fraction) & (bin_L >= min_lightness))[0]
+	significant = significant[numpy.lexsort((radius[significant], group[significant]))]
+	group_starts = numpy.nonzero(numpy.diff(group[significant]))[0] + 1
+
+	at_risk = numpy.zeros(bin_counts.shape[0], dtype=bool)
+	pairs = []
+	for members in numpy.split(significant, group_starts):
+		r = radius[members]
+		if (members.shape[0] < 2 or r[-1] - r[0] <= min_distance):
+			continue
+
+		# only colors of similar lightness can be confused
+		similar = numpy.abs(bin_L[members][:,numpy.newaxis] - bin_L[members][numpy.newaxis,:]) <= max_lightness_diff
+		confusable = similar & (numpy.abs(r[:,numpy.newaxis] - r[numpy.newaxis,:]) > min_distance)
+		at_risk[members[numpy.any(confusable, axis=1)]] = True
+
+		# worst pair on this line. far apart in xy, and both colors covering a lot of the image
+		distance = numpy.linalg.norm(bin_xy[members][:,numpy.newaxis,:] - bin_xy[members][numpy.newaxis,:,:], axis=2)
+		coverage = numpy.minimum(fractions[members][:,numpy.newaxis], fractions[members][numpy.newaxis,:])
+		score = numpy.where(similar & (distance > min_distance), distance * coverage, 0)
+		(a, b) = numpy.unravel_index(numpy.argmax(score), score.shape)
+		if (score[a,b] > 0):
+			pairs.append({
+				'score': score[a,b],
+				'distance': distance[a,b],
+				'fraction': (fractions[members[a]], fractions[members[b]]),
+				'rgb': (bin_rgb[members[a]], bin_rgb[members[b]]),
+			})
+
+	pairs = sorted(pairs, key=lambda pair: pair['score'], reverse=True)[0:num_pairs]
+
+	return {
+		'at_risk': numpy.sum(fractions[at_risk]),
+		'blind_side': blind_side,
+		'pairs': pairs,
+	}
+
+def hexColor(rgb):
+	return '#%02x%02x%02x' % tuple(int(round(value)) for value in rgb)
+
+
+# MAIN
+if __name__ == '__main__':
+	confusion_report()
@@ -18,6 +18,12 @@ import click
 
 ##
 from SimulateColorBlind import SimDaltonMapping
+from SimulateColorBlind import buildMask
+from SimulateColorBlind import RGBToxyY
+from SimulateColorBlind import xyYToRGB
+from SimulateColorBlind import transformImages
+from ExecutionPlanner import planExecution
+from ExecutionPlanner import executePlan
 
 
 # source for empirical studies on finding copunctal points. (Intersection points of 
@@ -43,9 +49,15 @@ xyY_WHITE_POINT = (1.0/3.0, 1.0/3.0)
 @click.option('-y', '--yes', 'yes_flag', is_flag=True, flag_value=True, help='Automatically confirm prompts.')
 @click.option('--sensitivity', 'sensitivity', default=0, type=click.FLOAT, help='Color blindness sensitivity.\n0: no response\n 1: full response')
 
+@click.option('--mask', 'mask_file_name', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=False), help='Mask image. Only pixels where the mask is non-zero are processed.')
+@click.option('--bbox', 'bbox', nargs=4, type=click.INT, default=None, help='Bounding box "x y width height". Only pixels inside the box are processed.')
+@click.option('--chroma-threshold', 'chroma_threshold', default=0, type=click.FLOAT, help='Only process pixels with chroma above this threshold.\nchroma = max(R,G,B) - min(R,G,B), from 0 to 1')
+@click.option('--strategy', 'strategy', default='auto', type=click.Choice(['auto', 'direct', 'dedup', 'palette', 'lut', 'tiled']), help='Execution strategy. auto picks the cheapest one for the image.')
+@click.option('--memory-limit', 'memory_limit', default=None, type=click.INT, help='Memory available for processing in MB. If unspecified the available system memory is used.')
+
 @click.option('-o', '--out', 'output_file_name', type=click.Path(exists=False, file_okay=True, dir_okay=False, resolve_path=False, writable=True), help='Set output file path. If unspecified default will be used.\n "[type]_[input_file].extension')
 @click.argument('input_file_name', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=False) )
-def correct(color_blind_type, sensitivity, show_flag, yes_flag, output_file_name, input_file_name):
+def correct(color_blind_type, sensitivity, show_flag, yes_flag, mask_file_name, bbox, chroma_threshold, strategy, memory_limit, output_file_name, input_file_name):
 	###
 	# Check output_file_name / output format
 	if (output_file_name is None):
@@ -66,6 +78,11 @@ def correct(color_blind_type, sensitivity, show_flag, yes_flag, output_file_name
 	print 'Sensitivity = ' + str(sensitivity)
 	print 'Show resulting image? = ' + str(show_flag)
 	print 'Autoconfirm prompts? = ' + str(yes_flag)
+	print 'Mask image = ' + str(mask_file_name)
+	print 'Bounding box = ' + str(bbox)
+	print 'Chroma threshold = ' + str(chroma_threshold)
+	print 'Strategy = ' + str(strategy)
+	print 'Memory limit = ' + str(memory_limit)
 	print ''
 	print 'Input image = "' + str(input_file_name) + '"'
 	print 'Output image = ' + str(output_file_name) + '"'
@@ -91,74 +108,23 @@ def correct(color_blind_type, sensitivity, show_flag, yes_flag, output_file_name
 
 
 	###
-	# convert to CIE 1931 XYZ
-	image_XYZ = skimage.color.convert_colorspace(image, fromspace='RGB', tospace='XYZ')
-	image_XYZ[image_XYZ <= 0] = .001
+	# build region-of-interest mask.
+	# pixels outside of the mask are copied through without any conversion.
+	mask = buildMask(image, mask_file_name, bbox, chroma_threshold)
+	print 'Processed pixels = ' + str(numpy.count_nonzero(mask)) + '/' + str(mask.size)
+	print ''
 
 
 	###
-	# convert to CIE 931 xyY
-	image_xy = numpy.zeros((image_XYZ.shape[0], image_XYZ.shape[1], 2), dtype=float)
-	image_Y = numpy.zeros(image_XYZ.shape[0:2], dtype=float)
-	image_xy[:,:,0] = image_XYZ[:,:,0] / (image_XYZ[:,:,0] + image_XYZ[:,:,1] + image_XYZ[:,:,2])
-	image_xy[:,:,1] = image_XYZ[:,:,1] / (image_XYZ[:,:,0] + image_XYZ[:,:,1] + image_XYZ[:,:,2])
-	image_Y = image_XYZ[:,:,1]
+	# plan how to process the image
+	if (memory_limit is not None):
+		memory_limit = memory_limit * (1 << 20)
+	plan = planExecution(image, mask, input_file_name, strategy, memory_limit)
 
 
 	###
 	# processing
-	mod_image_xy = numpy.zeros(image_xy.shape, dtype=float)
-	mod_image_Y = numpy.zeros(image_Y.shape, dtype=float)
-
-	if (color_blind_type == 'protanopia'): 
-		copunctal = numpy.array(R_COPUNCTAL, dtype=float)
-		blind_color_angle = R_BLIND_ANGLE
-		angle_to_white_point = R_ANGLE_TO_WHITE_POINT
-
-	elif (color_blind_type == 'deuteranopia'):
-		copunctal = numpy.array(G_COPUNCTAL, dtype=float)
-		blind_color_angle = G_BLIND_ANGLE
-		angle_to_white_point = G_ANGLE_TO_WHITE_POINT
-
-	elif (color_blind_type == 'tritanopia'):
-		copunctal = numpy.array(B_COPUNCTAL, dtype=float)
-		blind_color_angle = B_BLIND_ANGLE
-		angle_to_white_point = B_ANGLE_TO_WHITE_POINT
-
-	else:
-		print 'Invalid color_blind_type: ' + str(color_blind_type)
-		exit(1)
-
-	# for each pixel/color value. (in xy chromatic space)
-	for i,j in numpy.ndindex(image_xy.shape[0:2]):
-
-		# perform "inverse" operation on simulating color blindness
-		simdalton_value = SimDaltonMapping(image_xy[i,j], color_blind_type)
-		new_color_value = image_xy[i,j] - simdalton_value*(1-sensitivity)
-		new_color_value = new_color_value/(sensitivity)
-
-
-
-		# store new color value in modified xyY image.
-		mod_image_xy[i,j] = new_color_value
-
-
-	# We do not modify the luminances
-	mod_image_Y = image_Y
-
-
-	###
-	# convert back to CIE 1931 XYZ
-	mod_image_XYZ = numpy.zeros(image_XYZ.shape, dtype=float)
-	mod_image_XYZ[:,:,0] = (mod_image_Y/mod_image_xy[:,:,1]) * mod_image_xy[:,:,0] # (Y/y) * x
-	mod_image_XYZ[:,:,1] = mod_image_Y
-	mod_image_XYZ[:,:,2] = (mod_image_Y/mod_image_xy[:,:,1]) * (1 - mod_image_xy[:,:,0] - mod_image_xy[:,:,1]) # (Y/y) * (1 -x -y)
-
-
-	###
-	# convert back to RGB
-	mod_image = skimage.color.convert_colorspace(mod_image_XYZ, fromspace='XYZ', tospace='RGB')
-	mod_image = skimage.img_as_ubyte(mod_image)
+	mod_image = executePlan(plan, image, mask, correctPixels, color_blind_type, sensitivity)
 
 
 	###
@@ -199,6 +165,37 @@ def correct(color_blind_type, sensitivity, show_flag, yes_flag, output_file_name
 		pyplot.show()
 
 
+# pixels := numpy array of shape (N,3). dtype=uint8
+# color_blind_type := a string specifying color blind type
+# sensitivity := color blindness sensitivity, from 0 to 1. must be non-zero
+# returns numpy array of shape (N,3). dtype=uint8
+def correctPixels(pixels, color_blind_type, sensitivity):
+	if (pixels.shape[0] == 0):
+		return pixels.copy()
+
+	(pixels_xy, pixels_Y) = RGBToxyY(pixels)
+
+	if (color_blind_type not in ['protanopia', 'deuteranopia', 'tritanopia']):
+		print 'Invalid color_blind_type: ' + str(color_blind_type)
+		exit(1)
+
+	# perform "inverse" operation on simulating color blindness
+	# for each pixel/color value. (in xy chromatic space)
+	simdalton_value = SimDaltonMapping(pixels_xy, color_blind_type)
+	new_color_value = pixels_xy - simdalton_value*(1-sensitivity)
+	new_color_value = new_color_value/(sensitivity)
+
+	# store new color value in modified xyY image.
+	mod_pixels_xy = new_color_value
+
+	# We do not modify the luminances
+	mod_pixels_Y = pixels_Y
+
+	return xyYToRGB(mod_pixels_xy, mod_pixels_Y)
+
+# Corrects color blindness on a list of (small) images in one array pass. See transformImages.
+def correctImages(images, color_blind_type, sensitivity):
+	return transformImages(images, correctPixels, color_blind_type, sensitivity)
 
 
 # MAIN
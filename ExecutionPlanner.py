@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+# std python imports
+import os.path
+
+# other imports
+import numpy
+
+import PIL.Image
+
+
+# Execution strategies for applying a pixel transform to an image.
+#
+#	direct	transform every pixel in one array pass
+#	dedup	transform each unique color once, then map the results back to the pixels
+#	palette	transform only the palette of an indexed (eg. GIF) image
+#	lut		fill a lookup table over all 2^24 RGB colors, then look every pixel up
+#	tiled	direct, but band by band of rows to stay within the memory limit
+STRATEGIES = ['direct', 'dedup', 'palette', 'lut', 'tiled']
+
+# Cost model, relative to transforming one pixel. (measured with simulatePixels)
+EVAL_COST = 1.0			# transform one pixel/color
+UNIQUE_COST = 0.18		# numpy.unique() per pixel
+GATHER_COST = 0.05		# table lookup per pixel
+LUT_SIZE = 1 << 24
+
+# Memory model, in bytes.
+EVAL_BYTES = 300		# temporaries of one pixel transform, per pixel
+UNIQUE_BYTES = 24		# packed colors, sorted copy and inverse index, per pixel
+GATHER_BYTES = 8		# lookup index and result, per pixel
+LUT_BYTES = LUT_SIZE * 4	# RGB table and filled flags
+LUT_CHUNK = 1 << 20		# colors transformed per pass while filling the table
+
+# number of pixels sampled to estimate the unique color count
+NUM_SAMPLES = 1 << 16
+
+
+# Samples the input cheaply and picks the cheapest strategy that fits in memory.
+# image := numpy array of shape (M,N,3). dtype=uint8
+# mask := numpy array of shape (M,N). dtype=bool. pixels to process (None for all)
+# input_file_name := path the image was read from. used to detect indexed images (or None)
+# strategy := 'auto' or one of STRATEGIES to override the planner
+# memory_limit := bytes available to the transform (None to read it from the system)
+# returns a plan dictionary for executePlan()
+def planExecution(image, mask=None, input_file_name=None, strategy='auto', memory_limit=None):
+	num_pixels = image.shape[0]*image.shape[1] if (mask is None) else int(numpy.count_nonzero(mask))
+	pixels = image.reshape(-1, 3) if (mask is None) else image[mask]
+
+	if (memory_limit is None):
+		memory_limit = availableMemory()
+
+	palette, indices = readPalette(image, input_file_name)
+	num_colors = estimateUniqueColors(pixels)
+
+	###
+	# estimate (cost, memory) of every strategy
+	estimates = {}
+	estimates['direct'] = (num_pixels*EVAL_COST, num_pixels*EVAL_BYTES)
+	estimates['dedup'] = (num_pixels*(UNIQUE_COST + GATHER_COST) + num_colors*EVAL_COST, num_pixels*UNIQUE_BYTES + num_colors*EVAL_BYTES)
+	if (palette is not None):
+		estimates['palette'] = (num_pixels*GATHER_COST + palette.shape[0]*EVAL_COST, num_pixels*GATHER_BYTES + palette.shape[0]*EVAL_BYTES)
+	estimates['lut'] = (num_pixels*GATHER_COST + LUT_SIZE*EVAL_COST, num_pixels*GATHER_BYTES + LUT_BYTES + LUT_CHUNK*EVAL_BYTES)
+	band_rows = min(tiledBandRows(image.shape[1], memory_limit), max(image.shape[0], 1))
+	estimates['tiled'] = (num_pixels*EVAL_COST*1.05, min(image.shape[1]*band_rows, num_pixels)*EVAL_BYTES)
+
+	###
+	# pick strategy
+	reason = 'manual'
+	if (strategy != 'auto' and strategy not in estimates):
+		print 'Strategy ' + str(strategy) + ' is not possible for this image, planning automatically'
+		strategy = 'auto'
+
+	if (strategy == 'auto'):
+		reason = 'auto'
+		fits = [name for name in STRATEGIES if (name in estimates and (memory_limit is None or estimates[name][1] <= memory_limit))]
+		if (len(fits) == 0):
+			fits = ['tiled']
+		strategy = min(fits, key=lambda name: estimates[name][0])
+
+	plan = {
+		'strategy': strategy,
+		'reason': reason,
+		'estimates': estimates,
+		'num_pixels': num_pixels,
+		'num_colors': num_colors,
+		'palette': palette,
+		'indices': indices,
+		'band_rows': band_rows,
+		'memory_limit': memory_limit,
+	}
+	printPlan(image, plan)
+	return plan
+
+# Applies <pixel_function> to the pixels of <image> inside of <mask> following <plan>.
+# Pixels outside of the mask are copied through.
+# returns numpy array of shape (M,N,3). dtype=uint8
+def executePlan(plan, image, mask, pixel_function, color_blind_type, sensitivity):
+	strategy = plan['strategy']
+	mod_image = image.copy()
+	if (mask is None):
+		mask = numpy.ones(image.shape[0:2], dtype=bool)
+
+	if (strategy == 'direct'):
+		mod_image[mask] = pixel_function(image[mask], color_blind_type, sensitivity)
+
+	elif (strategy == 'dedup'):
+		(colors, inverse) = numpy.unique(packRGB(image[mask]), return_inverse=True)
+		mod_image[mask] = pixel_function(unpackRGB(colors), color_blind_type, sensitivity)[inverse]
+
+	elif (strategy == 'palette'):
+		mod_palette = pixel_function(plan['palette'], color_blind_type, sensitivity)
+		mod_image[mask] = mod_palette[plan['indices'][mask]]
+
+	elif (strategy == 'lut'):
+		color_lut = ColorLUT(pixel_function, color_blind_type, sensitivity)
+		color_lut.fill(LUT_CHUNK)
+		mod_image[mask] = color_lut.table[packRGB(image[mask])]
+
+	elif (strategy == 'tiled'):
+		band_rows = plan['band_rows']
+		for band_start in range(0, image.shape[0], band_rows):
+			band_mask = mask[band_start:band_start + band_rows]
+			band = image[band_start:band_start + band_rows]
+			mod_image[band_start:band_start + band_rows][band_mask] = pixel_function(band[band_mask], color_blind_type, sensitivity)
+
+	else:
+		print 'Invalid strategy: ' + str(strategy)
+		exit(1)
+
+	return mod_image
+
+def printPlan(image, plan):
+	memory_limit = plan['memory_limit']
+	print 'Planner: ' + str(image.shape[1]) + 'x' + str(image.shape[0]) + \
+		', pixels to process = ' + str(plan['num_pixels']) + \
+		', unique colors ~ ' + str(plan['num_colors']) + \
+		', indexed = ' + str(plan['palette'] is not None) + \
+		', memory limit = ' + (str(memory_limit // (1 << 20)) + ' MB' if (memory_limit is not None) else 'unknown')
+	for name in STRATEGIES:
+		if (name in plan['estimates']):
+			(cost, memory) = plan['estimates'][name]
+			print '  ' + name.ljust(8) + ' cost = ' + ('%.3g' % cost) + ', memory = ' + str(int(memory) // (1 << 20)) + ' MB'
+	print 'Strategy = ' + str(plan['strategy']) + ' (' + plan['reason'] + '), estimated cost = ' + ('%.3g' % plan['estimates'][plan['strategy']][0])
+	print ''
+
+# Estimates the number of unique colors from a random sample of <pixels>.
+# Uses the GEE estimator: colors seen once in the sample are scaled up by sqrt(N/n),
+# colors seen more often are assumed to be all there is.
+def estimateUniqueColors(pixels):
+	num_pixels = pixels.shape[0]
+	if (num_pixels <= NUM_SAMPLES):
+		return int(numpy.unique(packRGB(pixels)).shape[0])
+
+	sample = pixels[numpy.random.RandomState(0).randint(0, num_pixels, NUM_SAMPLES)]
+	(colors, counts) = numpy.unique(packRGB(sample), return_counts=True)
+	num_once = numpy.count_nonzero(counts == 1)
+	estimate = numpy.sqrt(num_pixels / float(NUM_SAMPLES)) * num_once + (colors.shape[0] - num_once)
+	return int(min(estimate, num_pixels, LUT_SIZE))
+
+# returns (palette, indices) if <input_file_name> is an indexed image whose palette
+# reproduces <image>, otherwise (None, None).
+#	palette := numpy array of shape (P,3). dtype=uint8
+#	indices := numpy array of shape (M,N). palette index of each pixel
+def readPalette(image, input_file_name):
+	if (input_file_name is None or not os.path.exists(input_file_name)):
+		return (None, None)
+
+	try:
+		indexed_image = PIL.Image.open(input_file_name)
+		if (indexed_image.mode != 'P'):
+			return (None, None)
+		indices = numpy.array(indexed_image)
+		palette = numpy.array(indexed_image.getpalette(), dtype=numpy.uint8).reshape(-1, 3)
+	except (IOError, ValueError):
+		return (None, None)
+
+	# the decoded image can differ from the palette (eg. transparency), so check
+	if (indices.shape != image.shape[0:2] or indices.max() >= palette.shape[0] or not (palette[indices] == image).all()):
+		return (None, None)
+
+	return (palette, indices)
+
+# returns the bytes of memory available, or None if unknown.
+def availableMemory():
+	try:
+		with open('/proc/meminfo', 'r') as meminfo:
+			for line in meminfo:
+				if (line.startswith('MemAvailable:')):
+					return int(line.split()[1]) * 1024
+	except IOError:
+		pass
+	return None
+
+# returns the number of rows per band so that one band fits in <memory_limit>.
+def tiledBandRows(width, memory_limit):
+	if (memory_limit is None):
+		return 256
+	return max(1, int(memory_limit // (2 * width * EVAL_BYTES)))
+
+
+# pixel transform for each mode, as (module, function).
+# every transform takes (pixels, color_blind_type, sensitivity) with pixels of shape (N,3), dtype=uint8
+PIXEL_FUNCTIONS = {
+	'simulate': ('SimulateColorBlind', 'simulatePixels'),
+	'correct': ('CorrectColorBlind', 'correctPixels'),
+	'contrast': ('ContrastRotate', 'contrastRotatePixels'),
+}
+
+# returns the pixel transform of <mode>.
+# The transform modules import this module, so they are only imported when asked for.
+def pixelFunction(mode):
+	(module_name, function_name) = PIXEL_FUNCTIONS[mode]
+	return getattr(__import__(module_name), function_name)
+
+
+# pixels := numpy array of shape (N,3). dtype=uint8
+# returns numpy array of shape (N,) with each color packed into a single 24-bit index.
+def packRGB(pixels):
+	return (pixels[:,0].astype(numpy.int32) << 16) | (pixels[:,1].astype(numpy.int32) << 8) | pixels[:,2].astype(numpy.int32)
+
+# index := numpy array of shape (N,) of 24-bit packed colors.
+# returns numpy array of shape (N,3). dtype=uint8
+def unpackRGB(index):
+	pixels = numpy.zeros((index.shape[0], 3), dtype=numpy.uint8)
+	pixels[:,0] = (index >> 16) & 0xff
+	pixels[:,1] = (index >> 8) & 0xff
+	pixels[:,2] = index & 0xff
+	return pixels
+
+
+# Lookup table over all 2^24 RGB colors for a pixel transform.
+# Entries are filled lazily, so each distinct color is only transformed once and later
+# occurrences (eg. in following video frames) are a single table lookup.
+class ColorLUT(object):
+	def __init__(self, pixel_function, color_blind_type, sensitivity):
+		self.pixel_function = pixel_function
+		self.color_blind_type = color_blind_type
+		self.sensitivity = sensitivity
+
+		self.table = numpy.zeros((LUT_SIZE, 3), dtype=numpy.uint8)
+		self.filled = numpy.zeros(LUT_SIZE, dtype=bool)
+
+	# pixels := numpy array of shape (N,3). dtype=uint8
+	# returns numpy array of shape (N,3). dtype=uint8
+	def apply(self, pixels):
+		index = packRGB(pixels)
+
+		missing = index[~self.filled[index]]
+		if (missing.shape[0] > 0):
+			missing = numpy.unique(missing)
+			self.table[missing] = self.pixel_function(unpackRGB(missing), self.color_blind_type, self.sensitivity)
+			self.filled[missing] = True
+
+		return self.table[index]
+
+	# Fills every entry of the table up front, <chunk_size> colors at a time.
+	def fill(self, chunk_size=1 << 20):
+		for start in range(0, LUT_SIZE, chunk_size):
+			index = numpy.arange(start, min(start + chunk_size, LUT_SIZE), dtype=numpy.int32)
+			index = index[~self.filled[index]]
+			if (index.shape[0] > 0):
+				self.table[index] = self.pixel_function(unpackRGB(index), self.color_blind_type, self.sensitivity)
+				self.filled[index] = True
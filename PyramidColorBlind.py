@@ -0,0 +1,384 @@
+#!/usr/bin/python
+
+# std python imports
+import os
+import os.path
+import math
+import json
+import uuid
+import shutil
+
+# other imports
+import numpy
+
+import skimage
+import skimage.io
+
+import click
+
+##
+from ExecutionPlanner import ColorLUT
+from ExecutionPlanner import pixelFunction
+
+
+# Writes the transformed image as a Deep Zoom (.dzi) tile pyramid.
+#
+#	<base>.dzi							descriptor read by the viewer
+#	<base>_files/<level>/<col>_<row>.png	tiles. level <max_level> is full resolution,
+#										every level below is half the size of the one above.
+#
+# The full pyramid is built band by band: each band of <tile_size> rows is transformed,
+# cut into tiles and halved into the band buffer of the next lower level, so no full size
+# transformed image is ever held in memory.
+# With --level only the tiles of that level covering --tile or --region are rendered.
+# Repeated requests are cheap, through a cache next to the pyramid:
+#
+#	<base>_cache/source.npy				decoded source, memory mapped instead of decoded per request
+#	<base>_cache/<level>/<col>_<row>.npy	float tiles below full resolution. a tile is built by
+#										halving its four tiles of the next higher level
+#
+# Tiles of a complete pyramid writen with the same settings are served as they are.
+# Both paths produce identical tiles.
+@click.command()
+@click.option('-m', '--mode', 'mode', default='simulate', type=click.Choice(['simulate', 'correct', 'contrast']), help='Transform to apply.')
+@click.option('-t', '--type', 'color_blind_type', type=click.Choice(['protanopia', 'deuteranopia', 'tritanopia']), help='Color blindness type')
+@click.option('-y', '--yes', 'yes_flag', is_flag=True, flag_value=True, help='Automatically confirm prompts.')
+@click.option('--sensitivity', 'sensitivity', default=0, type=click.FLOAT, help='Color blindness sensitivity.\n0: no response\n 1: full response')
+@click.option('--tile-size', 'tile_size', default=256, type=click.INT, help='Tile width and height in pixels. Must be even.')
+@click.option('--lut/--no-lut', 'lut_flag', default=True, help='Cache transformed colors in a RGB lookup table.')
+
+@click.option('--level', 'level', default=None, type=click.INT, help='Only render tiles of this zoom level.')
+@click.option('--tile', 'tile', nargs=2, type=click.INT, default=None, help='With --level, render the tile "col row".')
+@click.option('--region', 'region', nargs=4, type=click.INT, default=None, help='With --level, render the tiles covering "x y width height" (in pixels of that level).')
+
+@click.option('-o', '--out', 'output_base_name', type=click.Path(exists=False, file_okay=True, dir_okay=False, resolve_path=False, writable=True), help='Set output path without extension. If unspecified default will be used.\n "[type]_[input_file]"')
+@click.argument('input_file_name', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=False) )
+def pyramid(mode, color_blind_type, yes_flag, sensitivity, tile_size, lut_flag, level, tile, region, output_base_name, input_file_name):
+	###
+	# Check output_base_name
+	if (output_base_name is None):
+		(head, tail) = os.path.split(input_file_name)
+		(name, extension) = os.path.splitext(tail)
+
+		output_base_name = os.path.join(head, str(color_blind_type) + '_' + name)
+	else:
+		(output_base_name, extension) = os.path.splitext(output_base_name)
+
+	dzi_file_name = output_base_name + '.dzi'
+	files_dir = output_base_name + '_files'
+	cache_dir = output_base_name + '_cache'
+
+
+	###
+	# print options/arguments
+	print 'Mode = ' + str(mode)
+	print 'Color blind type = ' + str(color_blind_type)
+	sensitivity = numpy.clip(sensitivity, 0, 1)
+	print 'Sensitivity = ' + str(sensitivity)
+	print 'Autoconfirm prompts? = ' + str(yes_flag)
+	print 'Tile size = ' + str(tile_size)
+	print 'Use lookup table? = ' + str(lut_flag)
+	print 'Level = ' + str(level)
+	print 'Tile = ' + str(tile)
+	print 'Region = ' + str(region)
+	print ''
+	print 'Input image = "' + str(input_file_name) + '"'
+	print 'Output pyramid = "' + str(dzi_file_name) + '"'
+	print ''
+
+
+	###
+	# if sensitivyt is 0. we cannot perform correction
+	if (mode != 'simulate' and sensitivity == 0):
+		print 'Sensitivity == 0, cannot correct color blindness'
+		exit(1)
+
+	if (tile_size <= 0 or tile_size % 2 != 0):
+		print 'Tile size must be even: ' + str(tile_size)
+		exit(1)
+
+	if (level is not None and not tile and not region):
+		print '--level needs --tile or --region'
+		exit(1)
+
+
+	###
+	# read image. tile requests map the decoded source from the cache
+	source_stamp = sourceStamp(input_file_name)
+	tiles_key = source_stamp + [mode, color_blind_type, float(sensitivity), tile_size]
+	if (level is not None):
+		image = loadSource(input_file_name, cache_dir, source_stamp)
+	else:
+		image = readImage(input_file_name)
+
+	(height, width) = image.shape[0:2]
+	max_level = maxLevel(width, height)
+	print 'Image size = ' + str(width) + 'x' + str(height) + ', levels = ' + str(max_level + 1)
+	print ''
+
+
+	###
+	# pick the pixel transform
+	pixel_function = pixelFunction(mode)
+	if (lut_flag == True):
+		transform = ColorLUT(pixel_function, color_blind_type, sensitivity).apply
+	else:
+		transform = lambda pixels: pixel_function(pixels, color_blind_type, sensitivity)
+
+
+	###
+	# render only the requested tiles
+	if (level is not None):
+		if (level < 0 or level > max_level):
+			print 'Invalid level: ' + str(level) + '. Must be from 0 to ' + str(max_level)
+			exit(1)
+
+		if (tile):
+			tiles = [tuple(tile)]
+		else:
+			tiles = tilesInRegion(width, height, level, tile_size, region)
+
+		# tiles of a complete pyramid with the same settings are already there.
+		# other settings are about to overwrite some of its tiles, so it is no longer complete.
+		stored_pyramid = (readStamp(os.path.join(cache_dir, 'pyramid.json')) == tiles_key)
+		if (not stored_pyramid):
+			removeFile(os.path.join(cache_dir, 'pyramid.json'))
+		openTileCache(cache_dir, tiles_key)
+
+		writeDescriptor(dzi_file_name, width, height, tile_size)
+		num_written = 0
+		num_stored = 0
+		for (col, row) in tiles:
+			if (stored_pyramid and os.path.exists(tilePath(files_dir, level, col, row))):
+				num_stored += 1
+				continue
+
+			tile_image = cachedTile(image, transform, cache_dir, level, col, row, tile_size)
+			if (tile_image is None):
+				print 'Tile ' + str(col) + '_' + str(row) + ' is outside of level ' + str(level)
+				continue
+			writeTile(files_dir, level, col, row, tile_image)
+			num_written += 1
+
+		print 'Tiles writen = ' + str(num_written) + ', already stored = ' + str(num_stored)
+		print ''
+		return
+
+
+	###
+	# Save full pyramid
+	save = False
+	if (os.path.exists(dzi_file_name)):
+		print 'Output file "' + str(dzi_file_name) + '" already exists. '
+
+		if (yes_flag == True):
+			print 'Autoconfirming overwrite.'
+			save = True
+		else:
+			if (click.confirm('Overwrite?')):
+				save = True
+			else:
+				print 'Aborting write to file.'
+	else:
+		save = True
+
+	if (save == True):
+		removeFile(os.path.join(cache_dir, 'pyramid.json'))
+		num_tiles = writePyramid(image, transform, files_dir, tile_size)
+		writeDescriptor(dzi_file_name, width, height, tile_size)
+		writeStamp(cache_dir, 'pyramid.json', tiles_key)
+		print 'Pyramid writen to = "' + str(dzi_file_name) + '" (' + str(num_tiles) + ' tiles)'
+
+	print ''
+
+
+# returns the index of the full resolution level. level 0 is a single pixel.
+def maxLevel(width, height):
+	return int(math.ceil(math.log(max(width, height), 2))) if (max(width, height) > 1) else 0
+
+# returns (width, height) of <level>
+def levelSize(width, height, level):
+	scale = 2 ** (maxLevel(width, height) - level)
+	return ((width + scale - 1) // scale, (height + scale - 1) // scale)
+
+# returns the (col, row) of all tiles of <level> overlapping region (x, y, width, height).
+def tilesInRegion(width, height, level, tile_size, region):
+	(level_width, level_height) = levelSize(width, height, level)
+	(x, y, region_width, region_height) = region
+
+	x0 = max(x, 0) // tile_size
+	y0 = max(y, 0) // tile_size
+	x1 = (min(x + region_width, level_width) - 1) // tile_size
+	y1 = (min(y + region_height, level_height) - 1) // tile_size
+
+	return [(col, row) for row in range(y0, y1 + 1) for col in range(x0, x1 + 1)]
+
+# Halves rows of an image by averaging 2x2 blocks.
+# An odd last row/column is averaged on its own.
+# rows := numpy array of shape (M,N,3). dtype=float
+# returns numpy array of shape (ceil(M/2),ceil(N/2),3). dtype=float
+def downsampleHalf(rows):
+	padded = numpy.pad(rows, ((0, rows.shape[0] % 2), (0, rows.shape[1] % 2), (0, 0)), mode='edge')
+	(padded_height, padded_width) = padded.shape[0:2]
+	blocks = padded.reshape(padded_height // 2, 2, padded_width // 2, 2, 3)
+	return (blocks[:,0,:,0] + blocks[:,0,:,1] + blocks[:,1,:,0] + blocks[:,1,:,1]) / 4.0
+
+def toUbyte(rows):
+	return numpy.clip(numpy.round(rows), 0, 255).astype(numpy.uint8)
+
+def tilePath(files_dir, level, col, row):
+	return os.path.join(files_dir, str(level), str(col) + '_' + str(row) + '.png')
+
+def writeTile(files_dir, level, col, row, tile_image):
+	level_dir = os.path.join(files_dir, str(level))
+	if (not os.path.isdir(level_dir)):
+		os.makedirs(level_dir)
+	skimage.io.imsave(tilePath(files_dir, level, col, row), toUbyte(tile_image))
+
+def writeDescriptor(dzi_file_name, width, height, tile_size):
+	with open(dzi_file_name, 'w') as dzi_file:
+		dzi_file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		dzi_file.write('<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="png" Overlap="0" TileSize="' + str(tile_size) + '">\n')
+		dzi_file.write('  <Size Width="' + str(width) + '" Height="' + str(height) + '"/>\n')
+		dzi_file.write('</Image>\n')
+
+# Renders a single tile of <level>. Full resolution tiles transform the source pixels
+# underneath them. Lower tiles halve their (up to) four tiles of the next higher level,
+# which are cached in <cache_dir>, so every tile is only built once.
+# transform := function taking/returning numpy arrays of shape (N,3). dtype=uint8
+# returns numpy array of shape (tile height, tile width, 3). dtype=float. (None if outside the level)
+def cachedTile(image, transform, cache_dir, level, col, row, tile_size):
+	(height, width) = image.shape[0:2]
+	(level_width, level_height) = levelSize(width, height, level)
+	if (col < 0 or row < 0 or col*tile_size >= level_width or row*tile_size >= level_height):
+		return None
+
+	if (level == maxLevel(width, height)):
+		region = image[row*tile_size:(row+1)*tile_size, col*tile_size:(col+1)*tile_size]
+		return transform(numpy.ascontiguousarray(region).reshape(-1, 3)).reshape(region.shape).astype(float)
+
+	cache_path = os.path.join(cache_dir, str(level), str(col) + '_' + str(row) + '.npy')
+	if (os.path.exists(cache_path)):
+		return numpy.load(cache_path).astype(float)
+
+	# children to the right/below are None at the edge of the level
+	rows = []
+	for child_row in (2*row, 2*row + 1):
+		children = [cachedTile(image, transform, cache_dir, level + 1, child_col, child_row, tile_size) for child_col in (2*col, 2*col + 1)]
+		children = [child for child in children if child is not None]
+		if (len(children) > 0):
+			rows.append(numpy.concatenate(children, axis=1))
+
+	# float32 holds the halved values of uint8 tiles exactly for many levels
+	tile_image = downsampleHalf(numpy.concatenate(rows, axis=0)).astype(numpy.float32)
+	saveArray(cache_path, tile_image)
+	return tile_image.astype(float)
+
+# Builds every level of the pyramid, band by band.
+# returns the number of tiles writen.
+def writePyramid(image, transform, files_dir, tile_size):
+	(height, width) = image.shape[0:2]
+	max_level = maxLevel(width, height)
+
+	# per level: rows waiting to be cut into tiles, rows waiting to be halved
+	# into the next level, and the index of the next tile row.
+	tile_rows = [numpy.zeros((0, levelSize(width, height, level)[0], 3), dtype=float) for level in range(max_level + 1)]
+	half_rows = [numpy.zeros((0, levelSize(width, height, level)[0], 3), dtype=float) for level in range(max_level + 1)]
+	next_tile_row = [0] * (max_level + 1)
+	num_tiles = [0]
+
+	def pushRows(level, rows, final):
+		# cut complete tile rows. the last tile row of a level may be shorter.
+		tile_rows[level] = numpy.concatenate((tile_rows[level], rows))
+		while (tile_rows[level].shape[0] >= tile_size or (final and tile_rows[level].shape[0] > 0)):
+			band = tile_rows[level][0:tile_size]
+			for col in range((band.shape[1] + tile_size - 1) // tile_size):
+				writeTile(files_dir, level, col, next_tile_row[level], band[:, col*tile_size:(col+1)*tile_size])
+				num_tiles[0] += 1
+			tile_rows[level] = tile_rows[level][tile_size:]
+			next_tile_row[level] += 1
+
+		if (level == 0):
+			return
+
+		# halve row pairs into the next level. the last row of a level may be unpaired.
+		half_rows[level] = numpy.concatenate((half_rows[level], rows))
+		num_rows = half_rows[level].shape[0] if (final) else (half_rows[level].shape[0] // 2) * 2
+		if (num_rows > 0 or final):
+			down = downsampleHalf(half_rows[level][0:num_rows]) if (num_rows > 0) else half_rows[level - 1][0:0]
+			half_rows[level] = half_rows[level][num_rows:]
+			pushRows(level - 1, down, final)
+
+	for band_start in range(0, height, tile_size):
+		band = image[band_start:band_start + tile_size]
+		mod_band = transform(band.reshape(-1, 3)).reshape(band.shape).astype(float)
+		pushRows(max_level, mod_band, band_start + tile_size >= height)
+
+	return num_tiles[0]
+
+
+# reads <input_file_name> as numpy array of shape (M,N,3). dtype=uint8
+def readImage(input_file_name):
+	image = skimage.io.imread(input_file_name, as_grey=False)
+
+	# convert to 8-bit
+	image = skimage.img_as_ubyte(image, force_copy=False)
+
+	# remove alpha channel if present
+	return image[:,:,0:3]
+
+# returns what identifies the contents of <input_file_name>.
+def sourceStamp(input_file_name):
+	return [os.path.abspath(input_file_name), os.path.getsize(input_file_name), os.path.getmtime(input_file_name)]
+
+# returns the decoded source image, memory mapped from <cache_dir>/source.npy.
+# The source is only decoded again when the input file changed.
+def loadSource(input_file_name, cache_dir, source_stamp):
+	source_path = os.path.join(cache_dir, 'source.npy')
+	if (readStamp(os.path.join(cache_dir, 'source.json')) != source_stamp or not os.path.exists(source_path)):
+		print 'Caching decoded source in "' + str(source_path) + '"'
+		saveArray(source_path, readImage(input_file_name))
+		writeStamp(cache_dir, 'source.json', source_stamp)
+
+	return numpy.load(source_path, mmap_mode='r')
+
+# Drops the cached tiles if they were built with other settings than <tiles_key>.
+def openTileCache(cache_dir, tiles_key):
+	if (readStamp(os.path.join(cache_dir, 'tiles.json')) == tiles_key):
+		return
+
+	for name in os.listdir(cache_dir):
+		if (os.path.isdir(os.path.join(cache_dir, name))):
+			shutil.rmtree(os.path.join(cache_dir, name))
+	writeStamp(cache_dir, 'tiles.json', tiles_key)
+
+def readStamp(path):
+	try:
+		with open(path, 'r') as stamp_file:
+			return json.load(stamp_file)
+	except (IOError, ValueError):
+		return None
+
+def writeStamp(cache_dir, name, stamp):
+	if (not os.path.isdir(cache_dir)):
+		os.makedirs(cache_dir)
+	with open(os.path.join(cache_dir, name), 'w') as stamp_file:
+		json.dump(stamp, stamp_file)
+
+# Saves <array> through a temporary file, so a concurrent request never reads half of it.
+def saveArray(path, array):
+	(head, tail) = os.path.split(path)
+	if (not os.path.isdir(head)):
+		os.makedirs(head)
+	tmp_path = os.path.join(head, '.' + uuid.uuid4().hex + '_' + tail)
+	numpy.save(tmp_path, array)
+	os.rename(tmp_path, path)
+
+def removeFile(path):
+	if (os.path.exists(path)):
+		os.remove(path)
+
+
+# MAIN
+if __name__ == '__main__':
+	pyramid()
@@ -16,6 +16,10 @@ import skimage.io
 
 import click
 
+##
+from ExecutionPlanner import planExecution
+from ExecutionPlanner import executePlan
+
 
 # source for empirical studies on finding copunctal points. (Intersection points of 
 # confusion lines for dichromatic viewers
@@ -40,9 +44,15 @@ xyY_WHITE_POINT = (1.0/3.0, 1.0/3.0)
 @click.option('-y', '--yes', 'yes_flag', is_flag=True, flag_value=True, help='Automatically confirm prompts.')
 @click.option('--sensitivity', 'sensitivity', default=0, type=click.FLOAT, help='Color blindness sensitivity.\n0: no response\n 1: full response')
 
+@click.option('--mask', 'mask_file_name', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=False), help='Mask image. Only pixels where the mask is non-zero are processed.')
+@click.option('--bbox', 'bbox', nargs=4, type=click.INT, default=None, help='Bounding box "x y width height". Only pixels inside the box are processed.')
+@click.option('--chroma-threshold', 'chroma_threshold', default=0, type=click.FLOAT, help='Only process pixels with chroma above this threshold.\nchroma = max(R,G,B) - min(R,G,B), from 0 to 1')
+@click.option('--strategy', 'strategy', default='auto', type=click.Choice(['auto', 'direct', 'dedup', 'palette', 'lut', 'tiled']), help='Execution strategy. auto picks the cheapest one for the image.')
+@click.option('--memory-limit', 'memory_limit', default=None, type=click.INT, help='Memory available for processing in MB. If unspecified the available system memory is used.')
+
 @click.option('-o', '--out', 'output_file_name', type=click.Path(exists=False, file_okay=True, dir_okay=False, resolve_path=False, writable=True), help='Set output file path. If unspecified default will be used.\n "[type]_[input_file].extension')
 @click.argument('input_file_name', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=False) )
-def simulate(color_blind_type, sensitivity, show_flag, yes_flag, output_file_name, input_file_name):
+def simulate(color_blind_type, sensitivity, show_flag, yes_flag, mask_file_name, bbox, chroma_threshold, strategy, memory_limit, output_file_name, input_file_name):
 	###
 	# Check output_file_name / output format
 	if (output_file_name is None):
@@ -63,6 +73,11 @@ def simulate(color_blind_type, sensitivity, show_flag, yes_flag, output_file_nam
 	print 'Sensitivity = ' + str(sensitivity)
 	print 'Show resulting image? = ' + str(show_flag)
 	print 'Autoconfirm prompts? = ' + str(yes_flag)
+	print 'Mask image = ' + str(mask_file_name)
+	print 'Bounding box = ' + str(bbox)
+	print 'Chroma threshold = ' + str(chroma_threshold)
+	print 'Strategy = ' + str(strategy)
+	print 'Memory limit = ' + str(memory_limit)
 	print ''
 	print 'Input image = "' + str(input_file_name) + '"'
 	print 'Output image = ' + str(output_file_name) + '"'
@@ -82,111 +97,23 @@ def simulate(color_blind_type, sensitivity, show_flag, yes_flag, output_file_nam
 
 
 	###
-	# convert to CIE 1931 XYZ
-	image_XYZ = skimage.color.convert_colorspace(image, fromspace='RGB', tospace='XYZ')
-	image_XYZ[image_XYZ <= 0] = .001
+	# build region-of-interest mask.
+	# pixels outside of the mask are copied through without any conversion.
+	mask = buildMask(image, mask_file_name, bbox, chroma_threshold)
+	print 'Processed pixels = ' + str(numpy.count_nonzero(mask)) + '/' + str(mask.size)
+	print ''
 
 
 	###
-	# convert to CIE 931 xyY
-	image_xy = numpy.zeros((image_XYZ.shape[0], image_XYZ.shape[1], 2), dtype=float)
-	image_Y = numpy.zeros(image_XYZ.shape[0:2], dtype=float)
-	image_xy[:,:,0] = image_XYZ[:,:,0] / (image_XYZ[:,:,0] + image_XYZ[:,:,1] + image_XYZ[:,:,2])
-	image_xy[:,:,1] = image_XYZ[:,:,1] / (image_XYZ[:,:,0] + image_XYZ[:,:,1] + image_XYZ[:,:,2])
-	image_Y = image_XYZ[:,:,1]
+	# plan how to process the image
+	if (memory_limit is not None):
+		memory_limit = memory_limit * (1 << 20)
+	plan = planExecution(image, mask, input_file_name, strategy, memory_limit)
 
 
 	###
 	# processing
-	mod_image_xy = numpy.zeros(image_xy.shape, dtype=float)
-	mod_image_Y = numpy.zeros(image_Y.shape, dtype=float)
-
-	if (color_blind_type == 'protanopia'): 
-		copunctal = numpy.array(R_COPUNCTAL, dtype=float)
-		blind_color_angle = R_BLIND_ANGLE
-		angle_to_white_point = R_ANGLE_TO_WHITE_POINT
-
-	elif (color_blind_type == 'deuteranopia'):
-		copunctal = numpy.array(G_COPUNCTAL, dtype=float)
-		blind_color_angle = G_BLIND_ANGLE
-		angle_to_white_point = G_ANGLE_TO_WHITE_POINT
-
-	elif (color_blind_type == 'tritanopia'):
-		copunctal = numpy.array(B_COPUNCTAL, dtype=float)
-		blind_color_angle = B_BLIND_ANGLE
-		angle_to_white_point = B_ANGLE_TO_WHITE_POINT
-
-	else:
-		print 'Invalid color_blind_type: ' + str(color_blind_type)
-		exit(1)
-
-	# for each pixel/color value. (in xy chromatic space)
-	for i,j in numpy.ndindex(image_xy.shape[0:2]):
-		# find displacement/distance from copunctal poitn
-		disp_from_copunctal = image_xy[i,j] - copunctal
-		dist_from_copunctal = numpy.linalg.norm(disp_from_copunctal)
-
-		# find closest point to white point along the line between the copunctal and pixelvalue.
-		# found via projection
-		closest_disp_from_copunctal = numpy.vdot(xyY_WHITE_POINT - copunctal, disp_from_copunctal) * (disp_from_copunctal / numpy.square(dist_from_copunctal))
-		closest_dist_from_copunctal = numpy.linalg.norm(closest_disp_from_copunctal)
-		closest = copunctal + closest_disp_from_copunctal
-
-		# find displacement/distance from closest white point
-		disp_from_closest = image_xy[i,j] - closest
-		dist_from_closest = numpy.linalg.norm(disp_from_closest)
-
-		# check if on blind side
-		on_blind_side = onBlindSide(image_xy[i,j], color_blind_type)		
-
-
-		# rescale colors based on our <senstivity> and <on_blind_side>
-		# and calculate the new color values.
-		simdalton_value = SimDaltonMapping(image_xy[i,j], color_blind_type)
-
-		if (on_blind_side):
-			new_dist = sensitivity * dist_from_closest
-			new_color_value = closest + new_dist*(disp_from_closest/dist_from_closest)
-			#new_color_value = simdalton_value*(1-sensitivity) + image_xy[i,j]*(sensitivity)
-		else:
-			new_color_value = simdalton_value*(1-sensitivity) + image_xy[i,j]*(sensitivity)
-
-
-		# store new color value in modified xyY image.
-		mod_image_xy[i,j] = new_color_value
-
-		## DEBUG info
-		# if (i== 40 and j==60) or (i==40 and j==380) or (i==40 and j==225):
-		# 	print '+'
-		# 	print image_xy[i,j]
-		# 	print 'copunc', copunctal
-		# 	print 'disp', disp_from_copunctal
-		# 	print 'distance', dist_from_copunctal
-		# 	print 'abs angle', abs_angle
-		# 	print 'blind angle', blind_color_angle
-		# 	print 'angle diff', angle_diff
-		# 	print 'closest', closest
-		# 	#print 'non-blind sens', non_blind_sensitivity
-		# 	print 'new val', new_color_value
-		# 	print 'simdalton val', simdalton_value
-		# 	print '+'
-
-	# We do not modify the luminances
-	mod_image_Y = image_Y
-
-
-	###
-	# convert back to CIE 1931 XYZ
-	mod_image_XYZ = numpy.zeros(image_XYZ.shape, dtype=float)
-	mod_image_XYZ[:,:,0] = (mod_image_Y/mod_image_xy[:,:,1]) * mod_image_xy[:,:,0] # (Y/y) * x
-	mod_image_XYZ[:,:,1] = mod_image_Y
-	mod_image_XYZ[:,:,2] = (mod_image_Y/mod_image_xy[:,:,1]) * (1 - mod_image_xy[:,:,0] - mod_image_xy[:,:,1]) # (Y/y) * (1 -x -y)
-
-
-	###
-	# convert back to RGB
-	mod_image = skimage.color.convert_colorspace(mod_image_XYZ, fromspace='XYZ', tospace='RGB')
-	mod_image = skimage.img_as_ubyte(mod_image)
+	mod_image = executePlan(plan, image, mask, simulatePixels, color_blind_type, sensitivity)
 
 
 	###
@@ -261,7 +188,7 @@ B_SIMDALTON_END_POINT = numpy.array([0.665764, 0.334011], dtype=float)
 B_SIMDALTON_SLOPE = ( (B_SIMDALTON_END_POINT - B_SIMDALTON_START_POINT)[1] ) / ( (B_SIMDALTON_END_POINT - B_SIMDALTON_START_POINT)[0] )
 B_SIMDALTON_YINT = B_SIMDALTON_START_POINT[1] - (B_SIMDALTON_SLOPE * B_SIMDALTON_START_POINT[0])
 
-# xy_vector := numpy array of shape (2,). Assumes dtype=float.
+# xy_vector := numpy array of shape (2,) or (N,2). Assumes dtype=float.
 # color_blind_type := a string specifying color blind type
 def SimDaltonMapping(xy_vector, color_blind_type):
 	# check color blind type
@@ -286,15 +213,17 @@ def SimDaltonMapping(xy_vector, color_blind_type):
 
 	# compute slope and y-int of confusion line
 	disp_vector = xy_vector - copunctal
-	confusion_line_slope = disp_vector[1]/disp_vector[0]
-	confusion_line_yint = xy_vector[1] - (confusion_line_slope * xy_vector[0])
+	confusion_line_slope = disp_vector[...,1]/disp_vector[...,0]
+	confusion_line_yint = xy_vector[...,1] - (confusion_line_slope * xy_vector[...,0])
 
 	# compute intersecttion point
 	x = (simdalton_yint - confusion_line_yint) / (confusion_line_slope - simdalton_slope)
 	y = (confusion_line_slope * x) + confusion_line_yint
 
-	return numpy.array([x,y], dtype=float)
+	return numpy.stack([x,y], axis=-1).astype(float)
 
+# xy_vector := numpy array of shape (2,) or (N,2). Assumes dtype=float.
+# color_blind_type := a string specifying color blind type
 def onBlindSide(xy_vector, color_blind_type):
 	if (color_blind_type == 'protanopia'): 
 		copunctal = numpy.array(R_COPUNCTAL, dtype=float)
@@ -319,19 +248,7 @@ def onBlindSide(xy_vector, color_blind_type):
 	disp_from_copunctal = xy_vector - copunctal
 
 	# find angle of the confusion line.
-	# check if line is vertical
-	if (disp_from_copunctal[0] == 0):
-		angle = (numpy.pi/2) if (disp_from_copunctal[1]>0) else (numpy.pi*(3/2))
-	else:
-		angle = numpy.arctan(disp_from_copunctal[1]/disp_from_copunctal[0])
-	# account for left hemisphere of circle since arctan() output is only defined from [-pi/2, pi/2]
-	if(disp_from_copunctal[0] < 0):
-		angle = scipy.pi + angle
-	else:
-		angle = angle # do nothing
-
-	# abs_angle is restricted to be from [0, 2pi]
-	abs_angle = numpy.fmod(angle + 2*numpy.pi, 2*numpy.pi)
+	abs_angle = displacementAngle(disp_from_copunctal)
 	
 	# compare confusion line angle to angle towards white point.
 	angle_diff = abs_angle - angle_to_white_point
@@ -339,15 +256,215 @@ def onBlindSide(xy_vector, color_blind_type):
 	# depending on our color blind type, and our angle relative to the white point angle
 	# find out if we are on the "blind" side of the xyY colorspace
 	if(color_blind_type == 'protanopia' or color_blind_type == 'deuteranopia'):
-		on_blind_side = (True) if (angle_diff<=0) else (False)
+		on_blind_side = (angle_diff<=0)
 	elif (color_blind_type == 'tritanopia'):
-		on_blind_side = (True) if (angle_diff>=0) else (False)
+		on_blind_side = (angle_diff>=0)
 	else:
 		print 'Invalid color_blind_type: ' + str(color_blind_type)
 		exit(1)
 
 	return on_blind_side
 
+# Angle of a displacement in xy chromatic space, restricted to be from [0, 2pi].
+# disp_vector := numpy array of shape (2,) or (N,2). Assumes dtype=float.
+def displacementAngle(disp_vector):
+	# check if line is vertical
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		angle = numpy.where(disp_vector[...,0] == 0,
+			numpy.where(disp_vector[...,1]>0, numpy.pi/2, numpy.pi*(3/2)),
+			numpy.arctan(disp_vector[...,1]/disp_vector[...,0]))
+
+	# account for left hemisphere of circle since arctan() output is only defined from [-pi/2, pi/2]
+	angle = numpy.where(disp_vector[...,0] < 0, scipy.pi + angle, angle)
+
+	# restrict angle to be from [0, 2pi]
+	return numpy.fmod(angle + 2*numpy.pi, 2*numpy.pi)
+
+# Builds a region-of-interest mask for <image>. Pixels outside of the mask should be
+# copied through unmodified. All of the given masks are intersected.
+# image := numpy array of shape (M,N,3). dtype=uint8
+# mask_file_name := path to a mask image, non-zero pixels are inside the mask. (None to disable)
+# bbox := (x, y, width, height) of the region to process. (None to disable)
+# chroma_threshold := minimum chroma, max(R,G,B) - min(R,G,B) scaled to [0,1]. (0 to disable)
+# returns a numpy array of shape (M,N). dtype=bool
+def buildMask(image, mask_file_name=None, bbox=None, chroma_threshold=0):
+	mask = numpy.ones(image.shape[0:2], dtype=bool)
+
+	if (mask_file_name is not None):
+		mask_image = skimage.io.imread(mask_file_name, as_grey=True)
+		if (mask_image.shape[0:2] != image.shape[0:2]):
+			print 'Mask size ' + str(mask_image.shape[0:2]) + ' does not match image size ' + str(image.shape[0:2])
+			exit(1)
+		mask &= (mask_image > 0)
+
+	if (bbox):
+		(x, y, width, height) = bbox
+		bbox_mask = numpy.zeros(image.shape[0:2], dtype=bool)
+		bbox_mask[max(y, 0):max(y + height, 0), max(x, 0):max(x + width, 0)] = True
+		mask &= bbox_mask
+
+	# chroma is computed directly on the 8-bit RGB values so that near-neutral
+	# pixels can be rejected before any colorspace conversion is done.
+	if (chroma_threshold > 0):
+		chroma = image.max(axis=2).astype(int) - image.min(axis=2).astype(int)
+		mask &= (chroma > chroma_threshold*255)
+
+	return mask
+
+# pixels := numpy array of shape (N,3). dtype=uint8
+# returns (pixels_xy, pixels_Y). numpy arrays of shape (N,2) and (N,)
+def RGBToxyY(pixels):
+	###
+	# convert to CIE 1931 XYZ
+	pixels_XYZ = skimage.color.convert_colorspace(pixels[:,numpy.newaxis,:], fromspace='RGB', tospace='XYZ')[:,0,:]
+	pixels_XYZ[pixels_XYZ <= 0] = .001
+
+	###
+	# convert to CIE 931 xyY
+	pixels_xy = numpy.zeros((pixels_XYZ.shape[0], 2), dtype=float)
+	pixels_xy[:,0] = pixels_XYZ[:,0] / (pixels_XYZ[:,0] + pixels_XYZ[:,1] + pixels_XYZ[:,2])
+	pixels_xy[:,1] = pixels_XYZ[:,1] / (pixels_XYZ[:,0] + pixels_XYZ[:,1] + pixels_XYZ[:,2])
+	pixels_Y = pixels_XYZ[:,1]
+
+	return (pixels_xy, pixels_Y)
+
+# pixels_xy := numpy array of shape (N,2). dtype=float
+# pixels_Y := numpy array of shape (N,). dtype=float
+# returns numpy array of shape (N,3). dtype=uint8
+def xyYToRGB(pixels_xy, pixels_Y):
+	###
+	# convert back to CIE 1931 XYZ
+	pixels_XYZ = numpy.zeros((pixels_xy.shape[0], 3), dtype=float)
+	pixels_XYZ[:,0] = (pixels_Y/pixels_xy[:,1]) * pixels_xy[:,0] # (Y/y) * x
+	pixels_XYZ[:,1] = pixels_Y
+	pixels_XYZ[:,2] = (pixels_Y/pixels_xy[:,1]) * (1 - pixels_xy[:,0] - pixels_xy[:,1]) # (Y/y) * (1 -x -y)
+
+	###
+	# convert back to RGB
+	pixels = skimage.color.convert_colorspace(pixels_XYZ[:,numpy.newaxis,:], fromspace='XYZ', tospace='RGB')[:,0,:]
+	return skimage.img_as_ubyte(pixels)
+
+# pixels := numpy array of shape (N,3). dtype=uint8
+# color_blind_type := a string specifying color blind type
+# sensitivity := color blindness sensitivity, from 0 to 1
+# returns numpy array of shape (N,3). dtype=uint8
+def simulatePixels(pixels, color_blind_type, sensitivity):
+	if (pixels.shape[0] == 0):
+		return pixels.copy()
+
+	(pixels_xy, pixels_Y) = RGBToxyY(pixels)
+
+	if (color_blind_type == 'protanopia'): 
+		copunctal = numpy.array(R_COPUNCTAL, dtype=float)
+
+	elif (color_blind_type == 'deuteranopia'):
+		copunctal = numpy.array(G_COPUNCTAL, dtype=float)
+
+	elif (color_blind_type == 'tritanopia'):
+		copunctal = numpy.array(B_COPUNCTAL, dtype=float)
+
+	else:
+		print 'Invalid color_blind_type: ' + str(color_blind_type)
+		exit(1)
+
+	# find displacement/distance from copunctal point. (in xy chromatic space)
+	disp_from_copunctal = pixels_xy - copunctal
+	dist_from_copunctal = numpy.linalg.norm(disp_from_copunctal, axis=1)
+
+	# find closest point to white point along the line between the copunctal and pixelvalue.
+	# found via projection
+	projection = numpy.sum((xyY_WHITE_POINT - copunctal) * disp_from_copunctal, axis=1)
+	closest_disp_from_copunctal = projection[:,numpy.newaxis] * (disp_from_copunctal / numpy.square(dist_from_copunctal)[:,numpy.newaxis])
+	closest = copunctal + closest_disp_from_copunctal
+
+	# find displacement/distance from closest white point
+	disp_from_closest = pixels_xy - closest
+	dist_from_closest = numpy.linalg.norm(disp_from_closest, axis=1)
+
+	# check if on blind side
+	on_blind_side = onBlindSide(pixels_xy, color_blind_type)
+
+
+	# rescale colors based on our <senstivity> and <on_blind_side>
+	# and calculate the new color values.
+	simdalton_value = SimDaltonMapping(pixels_xy, color_blind_type)
+
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		new_dist = sensitivity * dist_from_closest
+		blind_color_value = closest + new_dist[:,numpy.newaxis]*(disp_from_closest/dist_from_closest[:,numpy.newaxis])
+	non_blind_color_value = simdalton_value*(1-sensitivity) + pixels_xy*(sensitivity)
+
+	# store new color value in modified xyY image.
+	mod_pixels_xy = numpy.where(on_blind_side[:,numpy.newaxis], blind_color_value, non_blind_color_value)
+
+	# We do not modify the luminances
+	mod_pixels_Y = pixels_Y
+
+	return xyYToRGB(mod_pixels_xy, mod_pixels_Y)
+
+# Transforms a list of images with a single call to <pixel_function>.
+# The pixels of all images are concatenated into one flat buffer, transformed in one
+# array pass and split back into separate images. This avoids the per call overhead
+# for many small images like thumbnails and icons.
+# images := list of numpy arrays of shape (M,N), (M,N,2), (M,N,3) or (M,N,4). Sizes may differ.
+#	gray images are transformed as RGB. alpha channels are passed through unmodified.
+# pixel_function := eg. simulatePixels. function(pixels, color_blind_type, sensitivity)
+# chunk_size := number of pixels to transform per array pass
+# returns list of numpy arrays of shape (M,N,3), or (M,N,4) for images with alpha. dtype=uint8
+def transformImages(images, pixel_function, color_blind_type, sensitivity, chunk_size=1 << 16):
+	rgb_images = []
+	alphas = []
+	for image in images:
+		image = skimage.img_as_ubyte(image, force_copy=False)
+		if (image.ndim == 2):
+			image = image[:,:,numpy.newaxis]
+
+		# split off alpha channel
+		if (image.shape[2] in [2, 4]):
+			alphas.append(image[:,:,-1])
+			image = image[:,:,0:-1]
+		else:
+			alphas.append(None)
+
+		# gray to RGB
+		if (image.shape[2] == 1):
+			image = numpy.repeat(image, 3, axis=2)
+
+		rgb_images.append(image)
+
+	###
+	# one flat buffer for all pixels
+	sizes = [image.shape[0]*image.shape[1] for image in rgb_images]
+	pixels = numpy.zeros((sum(sizes), 3), dtype=numpy.uint8)
+	offsets = numpy.cumsum([0] + sizes)
+	for (k, image) in enumerate(rgb_images):
+		pixels[offsets[k]:offsets[k+1]] = image.reshape(-1, 3)
+
+	# transform the buffer in chunks of whole images of about <chunk_size> pixels.
+	# very large passes are slower per pixel than several cache sized ones.
+	mod_pixels = numpy.zeros(pixels.shape, dtype=numpy.uint8)
+	start = 0
+	while (start < len(rgb_images)):
+		end = numpy.searchsorted(offsets, offsets[start] + chunk_size, side='right') - 1
+		end = min(max(end, start + 1), len(rgb_images))
+		mod_pixels[offsets[start]:offsets[end]] = pixel_function(pixels[offsets[start]:offsets[end]], color_blind_type, sensitivity)
+		start = end
+
+	###
+	# split back into images
+	mod_images = []
+	for (k, image) in enumerate(rgb_images):
+		mod_image = mod_pixels[offsets[k]:offsets[k+1]].reshape(image.shape)
+		if (alphas[k] is not None):
+			mod_image = numpy.dstack((mod_image, alphas[k]))
+		mod_images.append(mod_image)
+
+	return mod_images
+
+# Simulates color blindness on a list of (small) images in one array pass. See transformImages.
+def simulateImages(images, color_blind_type, sensitivity):
+	return transformImages(images, simulatePixels, color_blind_type, sensitivity)
+
 
 # MAIN
 if __name__ == '__main__':
@@ -0,0 +1,241 @@
+#!/usr/bin/python
+
+# std python imports
+import sys
+import io
+import errno
+import time
+import threading
+import Queue
+
+# other imports
+import numpy
+
+import click
+
+##
+from SimulateColorBlind import buildMask
+from ExecutionPlanner import ColorLUT
+from ExecutionPlanner import pixelFunction
+
+
+# number of frames that can be in flight between the reader, processing and writer threads.
+NUM_FRAME_BUFFERS = 2
+
+@click.command()
+@click.option('-m', '--mode', 'mode', default='simulate', type=click.Choice(['simulate', 'correct', 'contrast']), help='Transform to apply to each frame.')
+@click.option('-t', '--type', 'color_blind_type', type=click.Choice(['protanopia', 'deuteranopia', 'tritanopia']), help='Color blindness type')
+@click.option('--sensitivity', 'sensitivity', default=0, type=click.FLOAT, help='Color blindness sensitivity.\n0: no response\n 1: full response')
+@click.option('-W', '--width', 'width', required=True, type=click.INT, help='Frame width in pixels.')
+@click.option('-H', '--height', 'height', required=True, type=click.INT, help='Frame height in pixels.')
+@click.option('--lut/--no-lut', 'lut_flag', default=True, help='Cache transformed colors in a RGB lookup table that is filled as new colors show up.')
+@click.option('--prefill-lut', 'prefill_flag', is_flag=True, flag_value=True, help='Fill the whole lookup table before reading the first frame.')
+
+@click.option('--mask', 'mask_file_name', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=False), help='Mask image. Only pixels where the mask is non-zero are processed.')
+@click.option('--bbox', 'bbox', nargs=4, type=click.INT, default=None, help='Bounding box "x y width height". Only pixels inside the box are processed.')
+@click.option('--chroma-threshold', 'chroma_threshold', default=0, type=click.FLOAT, help='Only process pixels with chroma above this threshold.\nchroma = max(R,G,B) - min(R,G,B), from 0 to 1')
+def stream(mode, color_blind_type, sensitivity, width, height, lut_flag, prefill_flag, mask_file_name, bbox, chroma_threshold):
+	# Reads raw rgb24 frames from stdin and writes raw rgb24 frames to stdout.
+	# stdout carries the frames, so all messages are printed to stderr.
+	# see run_stream.sh for an example between two ffmpeg processes.
+
+	###
+	# print options/arguments
+	sensitivity = numpy.clip(sensitivity, 0, 1)
+	print >> sys.stderr, 'Mode = ' + str(mode)
+	print >> sys.stderr, 'Color blind type = ' + str(color_blind_type)
+	print >> sys.stderr, 'Sensitivity = ' + str(sensitivity)
+	print >> sys.stderr, 'Frame size = ' + str(width) + 'x' + str(height)
+	print >> sys.stderr, 'Use lookup table? = ' + str(lut_flag)
+	print >> sys.stderr, 'Prefill lookup table? = ' + str(prefill_flag)
+	print >> sys.stderr, 'Mask image = ' + str(mask_file_name)
+	print >> sys.stderr, 'Bounding box = ' + str(bbox)
+	print >> sys.stderr, 'Chroma threshold = ' + str(chroma_threshold)
+	print >> sys.stderr, ''
+
+
+	###
+	# if sensitivyt is 0. we cannot perform correction
+	if (mode != 'simulate' and sensitivity == 0):
+		print >> sys.stderr, 'Sensitivity == 0, cannot correct color blindness'
+		exit(1)
+
+	if (color_blind_type is None):
+		print >> sys.stderr, 'Invalid color_blind_type: ' + str(color_blind_type)
+		exit(1)
+
+
+	###
+	# pick the pixel transform
+	pixel_function = pixelFunction(mode)
+	if (lut_flag == True):
+		color_lut = ColorLUT(pixel_function, color_blind_type, sensitivity)
+		transform = color_lut.apply
+
+		if (prefill_flag == True):
+			print >> sys.stderr, 'Filling lookup table...'
+			color_lut.fill()
+	else:
+		transform = lambda pixels: pixel_function(pixels, color_blind_type, sensitivity)
+
+
+	###
+	# build the static part of the region-of-interest mask once.
+	# the chroma threshold depends on the frame contents, so it is applied per frame.
+	if (mask_file_name is None and not bbox):
+		mask = None
+	else:
+		mask = buildMask(numpy.zeros((height, width, 3), dtype=numpy.uint8), mask_file_name, bbox, 0)
+
+
+	###
+	# process frames
+	input_stream = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+	output_stream = io.open(sys.stdout.fileno(), 'wb', closefd=False)
+
+	start_time = time.time()
+	num_frames = streamFrames(input_stream, output_stream, width, height,
+		lambda frame, mod_frame: processFrame(frame, mod_frame, mask, chroma_threshold, transform))
+	elapsed_time = time.time() - start_time
+
+	print >> sys.stderr, 'Frames processed = ' + str(num_frames)
+	if (elapsed_time > 0):
+		print >> sys.stderr, 'Frames per second = ' + str(num_frames / elapsed_time)
+	print >> sys.stderr, ''
+
+
+# Applies <transform> to the pixels of <frame> inside of the mask and stores the result in <mod_frame>.
+# frame, mod_frame := numpy arrays of shape (height,width,3). dtype=uint8
+# mask := numpy array of shape (height,width). dtype=bool (None to process every pixel)
+# transform := function taking/returning numpy arrays of shape (N,3). dtype=uint8
+def processFrame(frame, mod_frame, mask, chroma_threshold, transform):
+	if (chroma_threshold > 0):
+		chroma_mask = buildMask(frame, None, None, chroma_threshold)
+		mask = chroma_mask if (mask is None) else (mask & chroma_mask)
+
+	if (mask is None):
+		mod_frame.reshape(-1, 3)[:] = transform(frame.reshape(-1, 3))
+	else:
+		mod_frame[...] = frame
+		mod_frame[mask] = transform(frame[mask])
+
+
+# Streams raw rgb24 frames from <input_stream> through <process> into <output_stream>.
+# Reading, processing and writing each run on their own thread and share a fixed set of
+# reused frame buffers, so the next frame is read and the previous frame written while
+# the current frame is being processed.
+# An error in the reader or writer thread stops the stream and is raised again here.
+# A closed output (broken pipe, eg. the downstream ffmpeg exited) is a clean stop.
+# process := function(frame, mod_frame). fills mod_frame from frame.
+# returns the number of frames processed.
+def streamFrames(input_stream, output_stream, width, height, process):
+	frame_size = width * height * 3
+
+	in_buffers = [bytearray(frame_size) for k in range(NUM_FRAME_BUFFERS)]
+	out_buffers = [bytearray(frame_size) for k in range(NUM_FRAME_BUFFERS)]
+	in_frames = [numpy.frombuffer(buf, dtype=numpy.uint8).reshape(height, width, 3) for buf in in_buffers]
+	out_frames = [numpy.frombuffer(buf, dtype=numpy.uint8).reshape(height, width, 3) for buf in out_buffers]
+
+	# queues hold buffer indices. None marks the end of the stream.
+	# the threads put sys.exc_info() tuples on full_in/free_out when they fail.
+	free_in = Queue.Queue()
+	full_in = Queue.Queue()
+	free_out = Queue.Queue()
+	full_out = Queue.Queue()
+	for k in range(NUM_FRAME_BUFFERS):
+		free_in.put(k)
+		free_out.put(k)
+
+	reader = threading.Thread(target=readFrames, args=(input_stream, in_buffers, free_in, full_in))
+	writer = threading.Thread(target=writeFrames, args=(output_stream, out_buffers, free_out, full_out))
+	reader.daemon = True
+	writer.daemon = True
+	reader.start()
+	writer.start()
+
+	num_frames = 0
+	error = None
+	writer_done = False
+	while True:
+		k = full_in.get()
+		if (isinstance(k, tuple)):
+			error = k
+		if (k is None or error is not None):
+			break
+
+		m = free_out.get()
+		if (isinstance(m, tuple)):
+			error = m
+			writer_done = True
+			break
+
+		process(in_frames[k], out_frames[m])
+		free_in.put(k)
+		full_out.put(m)
+		num_frames += 1
+
+	# let the writer finish the frames already processed
+	if (not writer_done):
+		full_out.put(None)
+		while True:
+			m = free_out.get()
+			if (m is None):
+				break
+			if (isinstance(m, tuple)):
+				error = m if (error is None) else error
+				break
+		writer.join()
+
+	if (error is not None):
+		if (isinstance(error[1], IOError) and error[1].errno == errno.EPIPE):
+			print >> sys.stderr, 'Output closed, stopping after ' + str(num_frames) + ' frames'
+		else:
+			raise error[0], error[1], error[2]
+
+	return num_frames
+
+
+# Reader thread. Fills free input buffers with whole frames.
+def readFrames(input_stream, buffers, free_queue, full_queue):
+	try:
+		while True:
+			k = free_queue.get()
+			view = memoryview(buffers[k])
+			num_read = 0
+			while (num_read < len(buffers[k])):
+				n = input_stream.readinto(view[num_read:])
+				if (not n):
+					break
+				num_read += n
+
+			if (num_read < len(buffers[k])):
+				if (num_read > 0):
+					print >> sys.stderr, 'Dropping incomplete frame at end of stream (' + str(num_read) + ' bytes)'
+				full_queue.put(None)
+				return
+
+			full_queue.put(k)
+	except Exception:
+		full_queue.put(sys.exc_info())
+
+
+# Writer thread. Writes full output buffers and hands them back.
+# Puts None on <free_queue> once everything is writen.
+def writeFrames(output_stream, buffers, free_queue, full_queue):
+	try:
+		while True:
+			k = full_queue.get()
+			if (k is None):
+				output_stream.flush()
+				free_queue.put(None)
+				return
+
+			output_stream.write(buffers[k])
+			free_queue.put(k)
+	except Exception:
+		free_queue.put(sys.exc_info())
+
+
+# MAIN
+if __name__ == '__main__':
+	stream()
@@ -0,0 +1,32 @@
+#!/bin/bash
+
+PRO="protanopia"
+DEU="deuteranopia"
+TRI="tritanopia"
+
+queue="./run_queue"
+
+output="./run_batch_result"
+
+sens=".3"
+
+# a job whose worker has not touched it for $timeout seconds is handed to another worker
+heartbeat="2"
+timeout="10"
+
+# Add one job per (image, type, sensitivity) to the queue.
+python BatchColorBlind.py submit --mode simulate --type $PRO --type $DEU --type $TRI --sensitivity $sens --out-dir $output $queue ./images/*.jpg
+
+# Start a worker and kill it mid-job, like a node going down. Its job stays in running/.
+python BatchColorBlind.py work --heartbeat $heartbeat --timeout $timeout $queue &
+sleep 5
+kill -9 $!
+python BatchColorBlind.py status $queue
+
+# Start several local workers. On a cluster run "work" on every node with the queue on shared storage.
+# They requeue the killed worker's job once its heartbeat is older than the timeout.
+python BatchColorBlind.py work --heartbeat $heartbeat --timeout $timeout --processes 2 $queue &
+python BatchColorBlind.py work --heartbeat $heartbeat --timeout $timeout --processes 2 $queue &
+wait
+
+python BatchColorBlind.py status $queue
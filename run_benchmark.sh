@@ -0,0 +1,8 @@
+#!/bin/bash
+
+input="./images/flowers.jpg"
+
+# Run the BenchmarkBatch.py script for all three transforms.
+for mode in simulate correct contrast; do
+	python BenchmarkBatch.py --mode $mode $input
+done | tee bench_output.txt
@@ -0,0 +1,10 @@
+#!/bin/bash
+
+PRO="protanopia"
+DEU="deuteranopia"
+TRI="tritanopia"
+
+output="./run_confusion.csv"
+
+# Run the ConfusionReport.py script on every image, for all three types.
+python ConfusionReport.py --csv $output ./images/*.jpg ./images/*.gif
@@ -0,0 +1,19 @@
+#!/bin/bash
+
+PRO="protanopia"
+DEU="deuteranopia"
+TRI="tritanopia"
+
+blindtype=$PRO
+
+input="./images/starry_night_normal.jpg"
+
+output="./run_result"
+
+sens=".3"
+
+# Write the full deep zoom pyramid (run_result.dzi + run_result_files/)
+python PyramidColorBlind.py --type $blindtype --sensitivity $sens --yes --out $output $input
+
+# Or only render the tiles a viewer asks for, eg. the top left corner of zoom level 9.
+python PyramidColorBlind.py --type $blindtype --sensitivity $sens --out $output --level 9 --region 0 0 512 512 $input
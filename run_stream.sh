@@ -0,0 +1,21 @@
+#!/bin/bash
+
+PRO="protanopia"
+DEU="deuteranopia"
+TRI="tritanopia"
+
+blindtype=$PRO
+
+input="./video.mp4"
+
+output="./run_result.mp4"
+
+width="640"
+height="480"
+
+sens=".3"
+
+# Decode to raw rgb24 frames, run the StreamColorBlind.py script, and encode the result.
+ffmpeg -loglevel error -i $input -f rawvideo -pix_fmt rgb24 -s $width"x"$height - |
+	python StreamColorBlind.py --mode simulate --type $blindtype --sensitivity $sens --width $width --height $height |
+	ffmpeg -loglevel error -y -f rawvideo -pix_fmt rgb24 -s $width"x"$height -i - -pix_fmt yuv420p $output